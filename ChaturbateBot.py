@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import io
+import atexit
 import logging
 import threading
 import time
@@ -9,38 +11,90 @@ from typing import List
 
 import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import Unauthorized
+from telegram.error import BadRequest, Unauthorized, RetryAfter
 from telegram.ext import CommandHandler, Updater, CallbackQueryHandler
+from telegram.ext.dispatcher import run_async
 
 from modules import Exceptions
+from modules import ImagePipeline
+from modules import LogPipeline
+from modules import Metrics
 from modules import Preferences
+from modules import Subscriptions
 from modules import Utils
-from modules.alchemy import Alchemy, PreferenceUser, ChaturbateUser, Admin
+from modules.AsyncPoller import AsyncPoller
+from modules.Broadcast import Broadcaster
+from modules.CircuitBreaker import CircuitBreaker
+from modules.ConcurrencyGovernor import ConcurrencyGovernor
+from modules.alchemy import Alchemy, PreferenceUser
 from modules.argparse_code import args as argparse_args
-from modules.Model import Model
+from modules.Model import Model, configure_endpoints, configure_http
+from modules.ModelCache import ModelCache
+from modules.NotificationDispatcher import NotificationDispatcher
+from modules.Outbox import OutboxConsumer
+from modules.PollScheduler import PollScheduler
+from modules.Profiler import Profiler
+from modules.ShardCoordinator import ShardCoordinator
+from modules.StatusBatch import StatusBatch
+from modules.SubscriptionIndex import SubscriptionIndex
 
-updater = Updater(token=argparse_args["key"], use_context=True)
+logging_level = logging.INFO
+if not Utils.str2bool(argparse_args["enable_logging"]):
+    logging_level = 99  # stupid workaround not to log -> only creates file
+
+# before anything logs, the first record would install a synchronous stderr handler
+LogPipeline.configure(argparse_args["logging_file"], logging_level, Utils.str2bool(argparse_args["log_queue"]),
+                      argparse_args["log_max_bytes"], argparse_args["log_backup_count"],
+                      argparse_args["log_rate_limit"], argparse_args["log_rate_interval"], argparse_args["log_sample"])
+
+updater = Updater(token=argparse_args["key"], base_url=argparse_args["telegram_url"],
+                  workers=argparse_args["dispatcher_workers"], use_context=True)
 dispatcher = updater.dispatcher
 bot = updater.bot  # bot class instance
 
 bot_path = argparse_args["working_folder"]
 wait_time = argparse_args["time"]
 http_threads = argparse_args["threads"]
+poller_mode = argparse_args["poller"]
+poller_concurrency = argparse_args["concurrency"]
 user_limit = argparse_args["limit"]
+add_timeout = argparse_args["add_timeout"]
 auto_remove = Utils.str2bool(argparse_args["remove"])
 admin_pw = argparse_args["admin_password"]
 logging_file = argparse_args["logging_file"]
-Utils.alchemy_instance = Alchemy(argparse_args["database_string"])
-
-logging_level = logging.INFO
-if not Utils.str2bool(argparse_args["enable_logging"]):
-    logging_level = 99  # stupid workaround not to log -> only creates file
-
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging_level, filename=logging_file)
-
-
-def send_message(chatid: str, messaggio: str, bot_p: updater.bot, html: bool = False, markup=None) -> None:
+reconcile_interval = argparse_args["reconcile_interval"]
+
+Utils.alchemy_instance = Alchemy(argparse_args["database_string"], Utils.str2bool(argparse_args["database_echo"]),
+                                 argparse_args["sqlite_busy_timeout"])
+Utils.subscription_index = SubscriptionIndex(Utils.alchemy_instance)
+configure_http(argparse_args["http_pool_size"], argparse_args["http_keepalive"], argparse_args["connect_timeout"],
+               argparse_args["read_timeout"])
+configure_endpoints(argparse_args["status_url"], argparse_args["image_url"])
+ImagePipeline.configure(argparse_args["image_max_size"], argparse_args["image_quality"],
+                        argparse_args["image_hash_threshold"])
+photo_file_id_ttl = argparse_args["file_id_ttl"]
+Model.autoupdate_interval = argparse_args["model_cache_ttl"]
+# every handler running at once checks its usernames with as many threads as a poll cycle
+model_cache = ModelCache(argparse_args["model_cache_ttl"], argparse_args["cache_size"],
+                         http_threads * argparse_args["dispatcher_workers"])
+concurrency_governor = None
+if Utils.str2bool(argparse_args["adaptive_concurrency"]):
+    concurrency_governor = ConcurrencyGovernor(argparse_args["min_concurrency"],
+                                               poller_concurrency if poller_mode == "asyncio" else http_threads)
+poll_scheduler = PollScheduler(argparse_args["min_poll_interval"], argparse_args["max_poll_interval"],
+                               argparse_args["retry_interval"])
+circuit_breaker = CircuitBreaker(argparse_args["breaker_threshold"], argparse_args["breaker_park_time"])
+shard_coordinator = None
+if Utils.str2bool(argparse_args["shard_poller"]):
+    shard_coordinator = ShardCoordinator(Utils.alchemy_instance, argparse_args["shard_lease_time"],
+                                         argparse_args["shard_heartbeat_interval"])
+notification_dispatcher = NotificationDispatcher(argparse_args["notification_workers"],
+                                                 argparse_args["global_rate_limit"],
+                                                 argparse_args["chat_rate_limit"])
+
+
+def send_message(chatid: str, messaggio: str, bot_p: updater.bot, html: bool = False, markup=None,
+                 automated: bool = False) -> bool:
     """
     Sends a message to a telegram user and sends "typing" action
 
@@ -50,6 +104,8 @@ def send_message(chatid: str, messaggio: str, bot_p: updater.bot, html: bool = F
     :param bot_p: telegram bot instance
     :param html: Enable html markdown parsing in the message
     :param markup: The reply_markup to use when sending the message
+    :param automated: Skip the "typing" action and raise RetryAfter to the notification dispatcher
+    :return: True if the message has been sent
     """
 
     disable_webpage_preview = not Preferences.get_user_link_preview_preference(
@@ -59,7 +115,8 @@ def send_message(chatid: str, messaggio: str, bot_p: updater.bot, html: bool = F
         chatid)  # the setting is opposite of preference
 
     try:
-        bot_p.send_chat_action(chat_id=chatid, action="typing")
+        if not automated:
+            bot_p.send_chat_action(chat_id=chatid, action="typing")
         if html and markup is not None:
             bot_p.send_message(chat_id=chatid, text=messaggio,
                                parse_mode=telegram.ParseMode.HTML, disable_web_page_preview=disable_webpage_preview,
@@ -74,17 +131,28 @@ def send_message(chatid: str, messaggio: str, bot_p: updater.bot, html: bool = F
         else:
             bot_p.send_message(chat_id=chatid, text=messaggio, disable_web_page_preview=disable_webpage_preview,
                                disable_notification=notification)
+        Metrics.notifications.inc(type="message", result="sent")
+        return True
     except Unauthorized:  # user blocked the bot
+        Metrics.notifications.inc(type="message", result="blocked")
         if auto_remove:
             logging.info(f"{chatid} blocked the bot, he's been removed from the database")
-            Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(
-                chat_id=str(chatid)).delete(synchronize_session=False)
+            Subscriptions.unsubscribe_all(chatid)
+            Utils.subscription_index.remove_chat(chatid)
             Preferences.remove_user_from_preferences(chatid)
+    except RetryAfter:
+        Metrics.notifications.inc(type="message", result="rate_limited")
+        if automated:
+            raise
+        logging.warning(f"Flood limit reached while sending to {chatid}")
     except Exception as e:
+        Metrics.notifications.inc(type="message", result="failed")
         Utils.handle_exception(e)
+    return False
 
 
-def send_image(chatid: str, image, bot_p: updater.bot, html: bool = False, markup=None, caption=None) -> None:
+def send_image(chatid: str, image, bot_p: updater.bot, html: bool = False, markup=None, caption=None,
+               automated: bool = False) -> (telegram.Message, None):
     """
     Sends an image to a telegram user and sends "sending image" action
 
@@ -95,44 +163,125 @@ def send_image(chatid: str, image, bot_p: updater.bot, html: bool = False, marku
     :param bot_p: telegram bot instance
     :param html: Enable html markdown parsing in the message
     :param markup: The reply_markup to use when sending the message
+    :param automated: Skip the "sending image" action and raise RetryAfter to the notification dispatcher
+    :return: The sent message, None if it could not be sent
     """
 
     notification = not Preferences.get_user_notifications_sound_preference(
         chatid)  # the setting is opposite of preference
 
     try:
-        bot_p.send_chat_action(chatid, action="upload_photo")
+        if not automated:
+            bot_p.send_chat_action(chatid, action="upload_photo")
         if html and markup is not None and caption is not None:
-            bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML, reply_markup=markup,
-                             disable_notification=notification, caption=caption)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML,
+                                       reply_markup=markup, disable_notification=notification, caption=caption)
         elif html and markup is not None:
-            bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML, reply_markup=markup,
-                             disable_notification=notification)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML,
+                                       reply_markup=markup, disable_notification=notification)
         elif markup is not None and caption is not None:
-            bot_p.send_photo(chat_id=chatid, photo=image, reply_markup=markup, disable_notification=notification,
-                             caption=caption)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, reply_markup=markup,
+                                       disable_notification=notification, caption=caption)
         elif html and caption is not None:
-            bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML,
-                             disable_notification=notification, caption=caption)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML,
+                                       disable_notification=notification, caption=caption)
         elif html:
-            bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML,
-                             disable_notification=notification)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, parse_mode=telegram.ParseMode.HTML,
+                                       disable_notification=notification)
         elif markup is not None:
-            bot_p.send_photo(chat_id=chatid, photo=image, reply_markup=markup, disable_notification=notification)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, reply_markup=markup,
+                                       disable_notification=notification)
         elif caption is not None:
-            bot_p.send_photo(chat_id=chatid, photo=image, disable_notification=notification, caption=caption)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, disable_notification=notification,
+                                       caption=caption)
         else:
-            bot_p.send_photo(chat_id=chatid, photo=image, disable_notification=notification)
+            message = bot_p.send_photo(chat_id=chatid, photo=image, disable_notification=notification)
+        Metrics.notifications.inc(type="photo", result="sent")
+        return message
     except Unauthorized:  # user blocked the bot
+        Metrics.notifications.inc(type="photo", result="blocked")
         if auto_remove:
             logging.info(f"{chatid} blocked the bot, he's been removed from the database")
-            Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(
-                chat_id=str(chatid)).delete(synchronize_session=False)
+            Subscriptions.unsubscribe_all(chatid)
+            Utils.subscription_index.remove_chat(chatid)
             Preferences.remove_user_from_preferences(chatid)
+    except RetryAfter:
+        Metrics.notifications.inc(type="photo", result="rate_limited")
+        if automated:
+            raise
+        logging.warning(f"Flood limit reached while sending to {chatid}")
     except Exception as e:
+        Metrics.notifications.inc(type="photo", result="failed")
         Utils.handle_exception(e)
 
 
+def get_stream_photo(username: str) -> tuple:
+    """
+    :param username: The username of the model
+    :return: (photo, image_hash), photo is the file_id of an uploaded image of the same frame or the image to upload
+    :raise The same exceptions as ModelCache.get_image
+    """
+    uploaded = Utils.photo_file_ids.get(username)
+    if uploaded is not None and time.time() - uploaded[2] < photo_file_id_ttl:
+        return uploaded[0], uploaded[1]  # uploaded in the last few seconds, it's still the latest image
+    model_instance = model_cache.get_image(username)
+    if uploaded is not None and ImagePipeline.similar(uploaded[1], model_instance.image_hash):
+        return uploaded[0], model_instance.image_hash
+    return model_instance.model_image, model_instance.image_hash
+
+
+def remember_stream_photo(username: str, chatid: str, message, photo, image_hash) -> None:
+    """
+    Caches the file_id of an uploaded stream image and the image shown by the message
+
+    :param username: The model the image belongs to
+    :param chatid: The chat the message has been sent to
+    :param message: The sent or edited message, None if sending failed
+    :param photo: What has been sent, a file_id or the uploaded image
+    :param image_hash: The perceptual hash of the image
+    """
+    if not isinstance(message, telegram.Message) or not message.photo:
+        return
+    if not isinstance(photo, str):
+        Utils.photo_file_ids.set(username, (message.photo[-1].file_id, image_hash, time.time()))
+    Utils.message_image_hashes.set((str(chatid), message.message_id), image_hash)
+
+
+def send_shared_image(chatid: str, username: str, upload: ImagePipeline.SharedUpload, bot_p: updater.bot,
+                      image_hash: int = None, **kwargs) -> None:
+    """
+    Sends a stream image shared by many notifications, uploading it only once
+
+    Every chat has its own notification queued at once, so it keeps its place among the other notifications of the
+    chat. The first one to run uploads the image, unless a similar frame has already been uploaded, the others wait
+    for it and receive the telegram file_id of the upload which is also cached for view_stream_image_callback.
+    If the upload fails the next notification tries again
+
+
+    :param chatid: The chatid of the user who will receive the image
+    :param username: The model the image belongs to
+    :param upload: The image shared by the notifications
+    :param bot_p: telegram bot instance
+    :param image_hash: The perceptual hash of the image
+    :param kwargs: Passed to send_image
+    """
+    with upload.lock:
+        image = upload.image
+        if isinstance(image, bytes):
+            uploaded = Utils.photo_file_ids.get(username)
+            if uploaded is not None and ImagePipeline.similar(uploaded[1], image_hash):
+                image = upload.image = uploaded[0]  # the same frame has already been uploaded
+        if isinstance(image, bytes):
+            message = send_image(chatid, io.BytesIO(image), bot_p, **kwargs)
+            remember_stream_photo(username, chatid, message, image, image_hash)
+            if message is not None and message.photo:
+                upload.image = message.photo[-1].file_id
+            return
+
+    message = send_image(chatid, image, bot_p, **kwargs)
+    remember_stream_photo(username, chatid, message, image, image_hash)
+
+
 # region normal functions
 
 
@@ -148,17 +297,18 @@ def start(update, context) -> None:
                  bot, html=True)
 
 
+add_rejection_reasons = {"deleted": "deleted", "banned": "banned", "geoblocked": "geoblocked",
+                         "canceled": "they don't exist", "error": "an error happened"}
+
+
 def add(update, context) -> None:
     global bot
     args = context.args
     chatid = update.message.chat_id
     username_message_list = []
+    usage = "You need to specify an username to follow, use the command like /add <b>username</b>\n You can also add multiple users at the same time by separating them using a comma, like /add <b>username1</b>,<b>username2</b>"
     if len(args) < 1:
-        send_message(
-            chatid,
-            "You need to specify an username to follow, use the command like /add <b>username</b>\n You can also add multiple users at the same time by separating them using a comma, like /add <b>username1</b>,<b>username2</b>",
-            bot, html=True
-        )
+        send_message(chatid, usage, bot, html=True)
         return
     # not lowercase usernames bug the api calls
     if len(args) > 1:
@@ -173,43 +323,60 @@ def add(update, context) -> None:
     else:
         username_message_list.append(Utils.sanitize_username(args[0]))
 
-    username_message_list = list(dict.fromkeys(username_message_list))  # remove duplicate usernames
+    # remove duplicate usernames and the ones left empty by the sanitization, like in /add ,,,
+    username_message_list = [username for username in dict.fromkeys(username_message_list) if username != ""]
+    if not username_message_list:
+        send_message(chatid, usage, bot, html=True)
+        return
 
-    usernames_in_database = Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(chat_id=str(chatid)).all()
+    usernames_in_database = set(Subscriptions.followed_usernames(chatid))
+    already_added = [username for username in username_message_list if username in usernames_in_database]
+    new_usernames = [username for username in username_message_list if username not in usernames_in_database]
 
     # 0 is unlimited usernames
-    if len(usernames_in_database) + len(username_message_list) > user_limit and (
+    if len(usernames_in_database) + len(new_usernames) > user_limit and (
             Utils.admin_check(chatid) == False != user_limit != 0):
         send_message(chatid,
                      "You are trying to add more usernames than your limit permits, which is " + str(user_limit), bot)
         logging.info(f'{chatid} tried to add more usernames than his limit permits')
         return
 
-    for username in username_message_list:
-        model_instance = Model(username)
-        if model_instance.status not in ('deleted', 'banned', 'geoblocked', 'canceled', 'error'):
-            if username not in usernames_in_database:
-                Utils.alchemy_instance.session.add(ChaturbateUser(username=username, chat_id=chatid, online=False))
-                Utils.alchemy_instance.session.commit()
-                send_message(chatid, f"{username} has been added", bot)
-                logging.info(f'{chatid} added {username}')
-            else:
-                send_message(chatid, f"{username} has already been added", bot)
-        elif model_instance.status == 'deleted':
-            send_message(chatid, f"{username} has not been added because is deleted", bot)
-            logging.info(f"{chatid} could not add {username} because is deleted")
-        elif model_instance.status == 'banned':
-            send_message(chatid, f"{username} has not been added because is banned", bot)
-            logging.info(f"{chatid} could not add {username} because is banned")
-        elif model_instance.status == 'geoblocked':
-            send_message(chatid, f"{username} has not been added because is geoblocked", bot)
-            logging.info(f"{chatid} could not add {username} because is geoblocked")
-        elif model_instance.status == 'canceled':
-            send_message(chatid, f"{username} was not added because it doesn't exist", bot)
-            logging.info(f'{chatid} tried to add {username}, which does not exist')
-        elif model_instance.status == 'error':
-            send_message(chatid, f"{username} was not added because an error happened", bot)
-            logging.info(f'{chatid} could not add {username} because an error happened')
+    # checked concurrently, the statuses found by the poller in the last seconds are reused
+    model_instances = model_cache.get_many(new_usernames, add_timeout)
+    not_added = {reason: [] for reason in add_rejection_reasons.values()}
+    not_added["could not be checked in time, try again"] = []
+    accepted = []
+    for username in new_usernames:
+        model_instance = model_instances.get(username)
+        if model_instance is None:
+            not_added["could not be checked in time, try again"].append(username)
+        elif model_instance.status in add_rejection_reasons:
+            not_added[add_rejection_reasons[model_instance.status]].append(username)
+        else:
+            accepted.append(username)
+
+    online_statuses = Subscriptions.subscribe(chatid, accepted)
+    for username in accepted:
+        Utils.subscription_index.add(username, chatid, online_statuses[username])
+    if accepted:
+        logging.info(f'{chatid} added {", ".join(accepted)}')
+    for reason, usernames in not_added.items():
+        if usernames:
+            logging.info(f'{chatid} could not add {", ".join(usernames)} because {reason}')
+
+    message = ""
+    offline_added = [username for username in accepted if not online_statuses[username]]
+    online_added = [username for username in accepted if online_statuses[username]]
+    if offline_added:
+        message += f"Added: {', '.join(offline_added)}\n"
+    if online_added:  # nobody will notify the transition, it already happened
+        message += f"Added and now online: {', '.join(online_added)}\n"
+    if already_added:
+        message += f"Already added: {', '.join(already_added)}\n"
+    for reason, usernames in not_added.items():
+        if usernames:
+            message += f"Not added because {reason}: {', '.join(usernames)}\n"
+    send_message(chatid, message, bot)
 
 
 def remove(update, context) -> None:
@@ -238,47 +405,95 @@ def remove(update, context) -> None:
     else:
         username_message_list.append(Utils.sanitize_username(args[0]))
 
-    usernames_in_database = Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(chat_id=str(chatid)).all()
+    usernames_in_database = set(Subscriptions.followed_usernames(chatid))
 
     if "all" in username_message_list:
-        Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(
-            chat_id=str(chatid)).all().delete(synchronize_session=False)
-        Utils.alchemy_instance.session.commit()
+        Subscriptions.unsubscribe_all(chatid)
+        Utils.subscription_index.remove_chat(chatid)
         send_message(chatid, "All usernames have been removed", bot)
         logging.info(f"{chatid} removed all usernames")
     else:
         for username in username_message_list:
             if username in usernames_in_database:
-                Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(
-                    chat_id=str(chatid), username=str(username)).delete(synchronize_session=False)
+                Subscriptions.unsubscribe(chatid, [username])
+                Utils.subscription_index.remove(username, chatid)
                 send_message(chatid, f"{username} has been removed", bot)
                 logging.info(f"{chatid} removed {username}")
             else:
                 send_message(chatid, f"You aren't following {username}", bot)
 
 
+list_page_size = 50  # 50 usernames of up to 60 characters stay under telegram's 4096 characters
+
+
+def render_list_page(chatid: int, online_only: bool, page: int) -> tuple:
+    """
+    Renders a page of /list, reusing the cached one until the followed models or their statuses change
+
+    :param chatid: The chatid of the follower
+    :param online_only: List only the models which are online
+    :param page: The page number, the last page is rendered if it's past the end
+    :return: (text, InlineKeyboardMarkup or None)
+    """
+    pages = Utils.list_pages.get(str(chatid))
+    if pages is None:
+        pages = {}
+        Utils.list_pages.set(str(chatid), pages)
+    rendered = pages.get((online_only, page))
+    if rendered is not None:
+        return rendered
+
+    followed_users, total = Subscriptions.followed_page(chatid, page * list_page_size, list_page_size, online_only)
+    page_count = max(1, -(-total // list_page_size))
+    if page >= page_count:  # the list got shorter since the page was shown
+        return render_list_page(chatid, online_only, page_count - 1)
+
+    if total == 0:
+        text = "None of the users you follow is online" if online_only else "You aren't following any user"
+    elif online_only:
+        text = f"{total} of the users you follow are online"
+    else:
+        text = f"You are currently following these {total} users"
+    if page_count > 1:
+        text += f", page {page + 1}/{page_count}"
+    text += ":\n" if total else ""
+    for username, online in followed_users:
+        text += f"{username}: " + ("<b>online</b>\n" if online else "offline\n")
+
+    filter_name = "online" if online_only else "all"
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("« Previous", callback_data=f"list_page_{filter_name}_{page - 1}"))
+    if page + 1 < page_count:
+        navigation.append(InlineKeyboardButton("Next »", callback_data=f"list_page_{filter_name}_{page + 1}"))
+    keyboard = [navigation] if navigation else []
+    if online_only:
+        keyboard.append([InlineKeyboardButton("All users", callback_data="list_page_all_0")])
+    elif total:
+        keyboard.append([InlineKeyboardButton("Online only", callback_data="list_page_online_0")])
+
+    rendered = (text, InlineKeyboardMarkup(keyboard) if keyboard else None)
+    pages[(online_only, page)] = rendered
+    return rendered
+
+
 def list_command(update, context) -> None:
     global bot
     chatid = update.message.chat_id
-    output_string = ""
+    text, markup = render_list_page(chatid, False, 0)
+    send_message(chatid, text, bot, html=True, markup=markup)
 
-    followed_users = Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(chat_id=chatid).all()
-    if followed_users is not None:  # an exception didn't happen
 
-        for user in sorted(followed_users, key=lambda l: l.username):
-            user: ChaturbateUser
-            output_string += f"{user.username}: "
-            if user.online:
-                output_string += "<b>online</b>\n"
-            else:
-                output_string += "offline\n"
-
-    if output_string == "":
-        send_message(chatid, "You aren't following any user", bot)
-    else:
-        send_message(
-            chatid, f"You are currently following these {len(followed_users)} users:\n" +
-                    output_string, bot, html=True)
+def list_page_callback(update, context) -> None:
+    query = update.callback_query
+    chatid = query.message.chat.id
+    filter_name, page = query.data[len("list_page_"):].split("_")
+    text, markup = render_list_page(chatid, filter_name == "online", int(page))
+    try:
+        query.edit_message_text(text=text, reply_markup=markup, parse_mode=telegram.ParseMode.HTML)
+    except BadRequest as e:  # pressed twice
+        if "not modified" not in str(e).lower():
+            raise
 
 
 def stream_image(update, context) -> None:
@@ -293,7 +508,6 @@ def stream_image(update, context) -> None:
         return
 
     username = Utils.sanitize_username(args[0])
-    model_instance = Model(username)
 
     if not Utils.admin_check(chatid):
         if Utils.is_chatid_temp_banned(chatid):
@@ -307,8 +521,11 @@ def stream_image(update, context) -> None:
         else:
             Utils.set_last_spam_date(chatid, datetime.datetime.now())
 
+    model_instance = model_cache.get(username)
+
     try:
-        send_image(chatid, model_instance.model_image, bot)
+        photo, image_hash = get_stream_photo(username)
+        remember_stream_photo(username, chatid, send_image(chatid, photo, bot), photo, image_hash)
         logging.info(f'{chatid} viewed {username} stream image')
 
     except Exceptions.ModelPrivate:
@@ -337,24 +554,47 @@ def stream_image(update, context) -> None:
         logging.warning(f'{chatid} could not view {username} stream image because of connection issues')
 
 
+def send_latest_update_message(chatid: str, username: str) -> None:
+    """
+    Tells the user the stream image hasn't changed, soft banning who keeps asking
+
+    :param chatid: The chatid of the user
+    :param username: The model whose image has been requested
+    """
+    send_message(chatid, f"This is the latest update of {username}", bot)
+    if not Utils.admin_check(chatid):
+        if Utils.get_last_spam_date(chatid) == None:
+            Utils.set_last_spam_date(chatid, datetime.datetime.now())
+        elif (datetime.datetime.now() - Utils.get_last_spam_date(chatid)).total_seconds() <= 3:
+            Utils.temp_ban_chatid(chatid, 25)
+            send_message(chatid, "You have been temporarily banned for spamming, try again later", bot)
+            logging.warning(f"Soft banned {chatid} for 25 seconds for spamming image updates")
+        else:
+            Utils.set_last_spam_date(chatid, datetime.datetime.now())
+
+
 def view_stream_image_callback(update, context):
     username = context.match.string.replace("view_stream_image_callback_", "")
     chatid = update.callback_query.message.chat_id
     messageid = update.callback_query.message.message_id
     if Utils.is_chatid_temp_banned(chatid):
         return
-    model_instance = Model(username)
 
     keyboard = [[InlineKeyboardButton("Watch the live", url=f'http://chaturbate.com/{username}'),
                  InlineKeyboardButton("Update stream image", callback_data='view_stream_image_callback_' + username)]]
     markup = InlineKeyboardMarkup(keyboard)
 
     try:
-        bot.edit_message_media(chat_id=chatid, message_id=messageid,
-                               media=telegram.InputMediaPhoto(model_instance.model_image,
-                                                              caption=f"{username} is now <b>online</b>!",
-                                                              parse_mode=telegram.ParseMode.HTML), reply_markup=markup)
-
+        photo, image_hash = get_stream_photo(username)
+        if ImagePipeline.similar(Utils.message_image_hashes.get((str(chatid), messageid)), image_hash):
+            send_latest_update_message(chatid, username)  # the message already shows this frame
+            return
+        message = bot.edit_message_media(chat_id=chatid, message_id=messageid,
+                                         media=telegram.InputMediaPhoto(photo,
+                                                                        caption=f"{username} is now <b>online</b>!",
+                                                                        parse_mode=telegram.ParseMode.HTML),
+                                         reply_markup=markup)
+        remember_stream_photo(username, chatid, message, photo, image_hash)
 
     except Exceptions.ModelPrivate:
         send_message(chatid, f"The model {username} is in private now, try again later", bot)
@@ -374,8 +614,9 @@ def view_stream_image_callback(update, context):
         markup = InlineKeyboardMarkup(keyboard)
         bot.edit_message_reply_markup(chat_id=chatid, message_id=messageid,
                                       reply_markup=markup)  # remove update image button
-        send_message(chatid, f"The model {username} cannot be seen because is {model_instance.status}", bot)
-        logging.warning(f'{chatid} could not view {username} image update because is {model_instance.status}')
+        status = model_cache.get(username).status
+        send_message(chatid, f"The model {username} cannot be seen because is {status}", bot)
+        logging.warning(f'{chatid} could not view {username} image update because is {status}')
 
     except Exceptions.ModelNotViewable:
         send_message(chatid, f"The model {username} is not visible", bot)
@@ -388,16 +629,7 @@ def view_stream_image_callback(update, context):
     except Exception as e:
         if hasattr(e, 'message'):
             if "Message is not modified" in e.message:
-                send_message(chatid, f"This is the latest update of {username}", bot)
-                if not Utils.admin_check(chatid):
-                    if Utils.get_last_spam_date(chatid) == None:
-                        Utils.set_last_spam_date(chatid, datetime.datetime.now())
-                    elif (datetime.datetime.now() - Utils.get_last_spam_date(chatid)).total_seconds() <= 3:
-                        Utils.temp_ban_chatid(chatid, 25)
-                        send_message(chatid, "You have been temporarily banned for spamming, try again later", bot)
-                        logging.warning(f"Soft banned {chatid} for 25 seconds for spamming image updates")
-                    else:
-                        Utils.set_last_spam_date(chatid, datetime.datetime.now())
+                send_latest_update_message(chatid, username)
 
 
 # endregion
@@ -519,8 +751,7 @@ def authorize_admin(update, context) -> None:
     if Utils.admin_check(chatid):
         send_message(chatid, "You already are an admin", bot)
     elif args[0] == admin_pw:
-        Utils.alchemy_instance.session.add(Admin(chatid))
-        Utils.alchemy_instance.session.commit()
+        Utils.add_admin(chatid)
         send_message(chatid, "Admin enabled", bot)
         send_message(chatid,
                      "Remember to disable the --admin-password if you want to avoid people trying to bruteforce this command",
@@ -539,22 +770,30 @@ def send_message_to_everyone(update, context) -> None:
         send_message(chatid, "You're not authorized to do this", bot)
         return
 
-    chatid_list = []
-    message = ""
-    start_time = datetime.datetime.now()
-
-    logging.info(f"{chatid} started sending a message to everyone")
+    message = " ".join(args)
+    if message == "":
+        send_message(chatid, "Use the command like this: /send_message_to_everyone <b>message</b>", bot, html=True)
+        return
+    broadcaster.start(chatid, message)  # the progress is reported by the broadcaster
 
-    chatid_list = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).all()
 
-    for word in args:
-        message += f"{word} "
-    message = message[:-1]
+def report_broadcast_progress(chatid: int, message_id: (int, None), text: str) -> (int, None):
+    """
+    Sends or updates the message with the progress of a broadcast
 
-    for x in chatid_list:
-        send_message(x.chat_id, message, bot)
-    logging.info(
-        f"{chatid} finished sending a message to everyone, took {(datetime.datetime.now() - start_time).total_seconds()} seconds")
+    :param chatid: The chatid of the admin who started the broadcast
+    :param message_id: The progress message to edit, None to send a new one
+    :param text: The progress
+    :return: The id of the progress message
+    """
+    if message_id is None:
+        return bot.send_message(chat_id=chatid, text=text).message_id
+    try:
+        bot.edit_message_text(text, chat_id=chatid, message_id=message_id)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    return message_id
 
 
 def active_users(update, context) -> None:
@@ -564,7 +803,7 @@ def active_users(update, context) -> None:
         send_message(chatid, "You're not authorized to do this", bot)
         return
 
-    users_count = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).count()
+    users_count = Utils.alchemy_instance.session.query(PreferenceUser).count()
     send_message(chatid, f"The active users are {users_count}", bot)
 
 
@@ -575,149 +814,345 @@ def active_models(update, context) -> None:
         send_message(chatid, "You're not authorized to do this", bot)
         return
 
-    models_count = Utils.alchemy_instance.session.query(ChaturbateUser.username).distinct().count()
+    models_count = Subscriptions.count_followed_models()
     send_message(chatid, f"The active models are {models_count}", bot)
 
 
-# endregion
+def cache_stats(update, context) -> None:
+    global bot
+    chatid = update.message.chat_id
+    if not Utils.admin_check(chatid):
+        send_message(chatid, "You're not authorized to do this", bot)
+        return
+
+    message = ""
+    for name, cache in (("Preferences", Preferences.preferences_cache), ("Admin", Utils.admin_cache)):
+        stats = cache.stats()
+        message += f"{name}: <b>{stats['hits']}</b> hits, <b>{stats['misses']}</b> misses, {stats['size']} cached\n"
+    send_message(chatid, message, bot, html=True)
 
-# region threads
 
-def check_online_status() -> None:
+def model_failures(update, context) -> None:
     global bot
+    chatid = update.message.chat_id
+    if not Utils.admin_check(chatid):
+        send_message(chatid, "You're not authorized to do this", bot)
+        return
 
-    def update_status() -> None:
-        username_list = []
-        chat_and_online_dict = {}
+    failure_counts = circuit_breaker.failure_counts()
+    if not failure_counts:
+        send_message(chatid, "No model is failing", bot)
+        return
 
-        # create a dictionary with usernames and online using distinct
+    parked = set(circuit_breaker.parked())
+    message = f"{len(failure_counts)} models are failing, {len(parked)} are parked:\n"
+    for username, failures in sorted(failure_counts.items(), key=lambda item: item[1], reverse=True)[:30]:
+        message += f"{username}: {failures}{' (parked)' if username in parked else ''}\n"
+    send_message(chatid, message, bot)
 
-        username_list = Utils.alchemy_instance.session.query(ChaturbateUser.username).distinct().all()
 
-        # obtain chatid
-        for username in username_list:
-            results: List[ChaturbateUser] = Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(
-                username=username).all()
-            chat_and_online_dict[username] = results  # assign (chatid,online) to every model
-
-        # Threaded function for queue processing.
-        def crawl(q, model_instances_dict):
-            while not q.empty():
-                username = Utils.sanitize_username(q.get()[1].username)
-                model_instance = Model(username, autoupdate=False)
-                model_instance.update_model_status()
-                try:
-                    model_instance.update_model_image()
-                except Exception:
-                    model_instance.model_image = None  # set to None just to be secure Todo: this may be extra
-
-                model_instances_dict[username] = model_instance
-                # signal to the queue that task has been processed
-                q.task_done()
-            return True
-
-        q = Queue(maxsize=0)
-        # Populating Queue with tasks
-        model_instances_dict = {}
-
-        # load up the queue with the username_list to fetch and the index for each job (as a tuple):
-        for index, value in enumerate(username_list):
-            # need the index and the username in each queue item.
-            q.put((index, value))
-
-            # Starting worker threads on queue processing
-        for i in range(http_threads):
-            worker = threading.Thread(target=crawl, args=(q, model_instances_dict), daemon=True)
-            worker.start()
-            time.sleep(wait_time)  # avoid server spamming by time-limiting the start of requests
-
-        # now we wait until the queue has been processed
-        q.join()
+def profile(update, context) -> None:
+    global bot
+    args = context.args
+    chatid = update.message.chat_id
 
-        for username in username_list:
-            model_instance = model_instances_dict[username]
-            keyboard_with_link_preview = [
-                [InlineKeyboardButton("Watch the live", url=f'http://chaturbate.com/{username}'),
-                 InlineKeyboardButton("Update stream image", callback_data='view_stream_image_callback_' + username)]]
-            keyboard_without_link_preview = [
-                [InlineKeyboardButton("Watch the live", url=f'http://chaturbate.com/{username}')]]
-            markup_with_link_preview = InlineKeyboardMarkup(keyboard_with_link_preview)
-            markup_without_link_preview = InlineKeyboardMarkup(keyboard_without_link_preview)
+    if not Utils.admin_check(chatid):
+        send_message(chatid, "You're not authorized to do this", bot)
+        return
 
-            try:
+    if len(args) not in (2, 3) or args[0] not in ("cycles", "handlers") or not args[1].isdigit() or int(args[1]) == 0 \
+            or (args[0] == "cycles" and len(args) == 3):
+        message = "Use the command like this: /profile cycles <b>count</b> or /profile handlers <b>count</b> " \
+                  "[<b>handler</b>]"
+        for session in profiler.running():
+            message += f"\n{session.remaining} {session.kind} left to profile"
+        send_message(chatid, message, bot, html=True)
+        return
+
+    kind, count = args[0], int(args[1])
+    handler = args[2] if len(args) == 3 else None
+    profiler.start(kind, count, chatid, handler)
+    send_message(chatid, f"Profiling the next {count} {kind}{f' of {handler}' if handler else ''}, "
+                         f"you'll receive the summary when it's done", bot)
 
-                if model_instance.status != "error":
-                    for chatid_tuple in chat_and_online_dict[username]:
-                        chat_id = chatid_tuple.chat_id
-                        db_status = chatid_tuple.online
-
-                        if model_instance.online and db_status == False:
-
-                            if model_instance.status in {"away", "private", "hidden",
-                                                         "password"}:  # assuming the user knows the password
-                                Utils.alchemy_instance.session.query(ChaturbateUser).filter(
-                                    ChaturbateUser.username == username and ChaturbateUser.chat_id == chat_id).update(
-                                    {ChaturbateUser.online: True}, synchronize_session=False)
-                                send_message(chat_id,
-                                             f"{username} is now <b>online</b>!\n<i>No link preview can be provided</i>",
-                                             bot, html=True,
-                                             markup=markup_without_link_preview)
-                            else:
-                                Utils.alchemy_instance.session.query(ChaturbateUser).filter(
-                                    ChaturbateUser.username == username and ChaturbateUser.chat_id == chat_id).update(
-                                    {ChaturbateUser.online: True}, synchronize_session=False)
-
-                                if Preferences.get_user_link_preview_preference(
-                                        chat_id) and model_instance.model_image is not None:
-                                    send_image(chat_id, model_instance.model_image, bot,
-                                               markup=markup_with_link_preview,
-                                               caption=f"{username} is now <b>online</b>!", html=True)
-                                else:
-                                    send_message(chat_id, f"{username} is now <b>online</b>!", bot, html=True,
-                                                 markup=markup_without_link_preview)
-
-                        elif model_instance.online == False and db_status:
-                            Utils.alchemy_instance.session.query(ChaturbateUser).filter(
-                                ChaturbateUser.username == username and ChaturbateUser.chat_id == chat_id).update(
-                                {ChaturbateUser.online: False}, synchronize_session=False)
-                            send_message(chat_id, f"{username} is now <b>offline</b>", bot, html=True)
-
-                        if model_instance.status == "deleted":
-                            Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(username=username,
-                                                                                           chat_id=chat_id).delete(
-                                synchronize_session=False)
-                            send_message(chat_id, f"{username} has been removed because room has been deleted", bot)
-                            logging.info(f"{username} has been removed from {chat_id} because room has been deleted")
-
-                        elif model_instance.status == "banned":
-                            Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(username=username,
-                                                                                           chat_id=chat_id).delete(
-                                synchronize_session=False)
-                            send_message(chat_id, f"{username} has been removed because room has been banned", bot)
-                            logging.info(f"{username} has been removed from {chat_id} because has been banned")
-
-                        elif model_instance.status == "canceled":
-                            Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(username=username,
-                                                                                           chat_id=chat_id).delete(
-                                synchronize_session=False)
-                            send_message(chat_id, f"{username} has been removed because room has been canceled", bot)
-                            logging.info(f"{username} has been removed from {chat_id} because has been canceled")
-
-                        elif model_instance.status == "geoblocked":
-                            Utils.alchemy_instance.session.query(ChaturbateUser).filter_by(username=username,
-                                                                                           chat_id=chat_id).delete(
-                                synchronize_session=False)
-                            send_message(chat_id,
-                                         f"{username} has been removed because of geoblocking",
-                                         bot)
-                            logging.info(f"{username} has been removed from {chat_id} because of geoblocking")
 
+# endregion
+
+# region threads
+
+def run_with_threads(items: list, worker_function) -> None:
+    """
+    Calls worker_function on every item using http_threads worker threads
+
+    :param items: The items to process
+    :param worker_function: The function called with every item
+    """
+
+    # Threaded function for queue processing.
+    def crawl(q):
+        while not q.empty():
+            item = q.get()[1]
+            try:
+                worker_function(item)
             except Exception as e:
                 Utils.handle_exception(e)
+            # signal to the queue that task has been processed
+            q.task_done()
+        return True
+
+    q = Queue(maxsize=0)
+
+    # load up the queue with the items to process and the index for each job (as a tuple):
+    for index, value in enumerate(items):
+        # need the index and the item in each queue item.
+        q.put((index, value))
+
+        # Starting worker threads on queue processing
+    for i in range(min(http_threads, len(items))):
+        worker = threading.Thread(target=crawl, args=(q,), daemon=True)
+        worker.start()
+        time.sleep(wait_time)  # avoid server spamming by time-limiting the start of requests
+
+    # now we wait until the queue has been processed
+    q.join()
+
+
+def crawl_with_threads(username_list: List[str]) -> dict:
+    """
+    Checks the status of every username using http_threads worker threads
+
+    :param username_list: The usernames to check
+    :return: A dict of username -> Model
+    """
+    model_instances_dict = {}
+
+    def update_model(username: str) -> None:
+        model_instance = Model(username, autoupdate=False)
+        if concurrency_governor is None:
+            model_instance.update_model_status(attempts=1)  # failed checks are retried by poll_scheduler
+        else:
+            concurrency_governor.acquire()
+            start = time.perf_counter()
+            try:
+                model_instance.update_model_status(attempts=1)
+            finally:
+                concurrency_governor.release()
+            concurrency_governor.record(time.perf_counter() - start, ok=model_instance.status != "error",
+                                        blocked=model_instance.blocked)
+        model_instances_dict[username] = model_instance
+
+    run_with_threads(username_list, update_model)
+    return model_instances_dict
 
+
+def fetch_images_with_threads(model_instances: List[Model]) -> None:
+    """
+    Downloads the stream image of every model using http_threads worker threads
+
+    :param model_instances: The models to download the image of
+    """
+
+    def update_image(model_instance: Model) -> None:
+        try:
+            model_instance.update_model_image(attempts=2, retry_delay=0)
+        except Exception:
+            model_instance.model_image = None
+
+    run_with_threads(model_instances, update_image)
+
+
+removal_reasons = {"deleted": "room has been deleted", "banned": "room has been banned",
+                   "canceled": "room has been canceled", "geoblocked": "of geoblocking"}
+no_preview_statuses = {"away", "private", "hidden", "password"}  # assuming the user knows the password
+
+
+def queue_notifications(events: List[tuple], images: dict) -> None:
+    """
+    Queues the notifications of persisted status changes on the notification dispatcher
+
+    :param events: (kind, username, status, chatids) tuples, kind is online, offline or removed
+    :param images: username -> (stream image, image hash), the models which went online without one get text only
+    """
+    uploads = {}  # username -> SharedUpload, the image is uploaded once and then sent by file_id
+    for kind, username, status, chatids in events:
+        markup_without_link_preview = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Watch the live", url=f'http://chaturbate.com/{username}')]])
+        markup_with_link_preview = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Watch the live", url=f'http://chaturbate.com/{username}'),
+              InlineKeyboardButton("Update stream image", callback_data='view_stream_image_callback_' + username)]])
+        for chat_id in chatids:
+            Utils.list_pages.invalidate(str(chat_id))
+            if kind == "online":
+                if status in no_preview_statuses:
+                    notification_dispatcher.put(chat_id, send_message, chat_id,
+                                                f"{username} is now <b>online</b>!\n<i>No link preview can be provided</i>",
+                                                bot, html=True, markup=markup_without_link_preview, automated=True)
+                elif username in images and Preferences.get_user_link_preview_preference(chat_id):
+                    if username not in uploads:
+                        uploads[username] = ImagePipeline.SharedUpload(images[username][0])
+                    notification_dispatcher.put(chat_id, send_shared_image, chat_id, username, uploads[username], bot,
+                                                image_hash=images[username][1], markup=markup_with_link_preview,
+                                                caption=f"{username} is now <b>online</b>!", html=True,
+                                                automated=True)
+                else:
+                    notification_dispatcher.put(chat_id, send_message, chat_id, f"{username} is now <b>online</b>!",
+                                                bot, html=True, markup=markup_without_link_preview, automated=True)
+            elif kind == "offline":
+                notification_dispatcher.put(chat_id, send_message, chat_id, f"{username} is now <b>offline</b>", bot,
+                                            html=True, automated=True)
+            elif kind == "removed":
+                notification_dispatcher.put(chat_id, send_message, chat_id,
+                                            f"{username} has been removed because {removal_reasons[status]}", bot,
+                                            automated=True)
+
+
+def handle_outbox_events(events: List[tuple]) -> None:
+    """
+    Notifies the status changes published by the pollers, downloading the stream images which are needed
+
+    :param events: (kind, username, status, chatids) tuples, chatids is None for the events of every follower
+    """
+    followers = Subscriptions.subscribers({username for kind, username, status, chatids in events if chatids is None})
+    events = [(kind, username, status, chatids if chatids is not None else followers.get(username, []))
+              for kind, username, status, chatids in events]
+    usernames = {username for kind, username, status, chatids in events
+                 if kind == "online" and status not in no_preview_statuses
+                 and any(Preferences.get_user_link_preview_preference(chat_id) for chat_id in chatids)}
+    images = {}
+
+    def fetch_image(username: str) -> None:
+        try:
+            model_instance = model_cache.get_image(username)
+            images[username] = (model_instance.model_image.getvalue(), model_instance.image_hash)
+        except Exception as e:  # notified without the image
+            logging.info(f"Could not download the stream image of {username}: {e!r}")
+
+    run_with_threads(list(usernames), fetch_image)
+    queue_notifications(events, images)
+
+
+def check_online_status(publish_to_outbox: bool = False) -> None:
+    """
+    Polls the followed models forever
+
+    :param publish_to_outbox: Publish the status changes to the outbox for the bot instead of notifying them
+    """
+    global bot
+    async_poller = None
+    if poller_mode == "asyncio":
+        async_poller = AsyncPoller(poller_concurrency, concurrency_governor)
+        atexit.register(async_poller.close)
+
+    owned_usernames = set()  # the models of this worker's shard in the last cycle
+
+    def update_status() -> None:
+        with profiler.stage("load"):
+            # username -> (online, chatids), kept in memory so a cycle doesn't read the database
+            subscriptions = Utils.subscription_index.snapshot()
+            if shard_coordinator is not None:  # the other models are polled by the other workers
+                subscriptions = {username: subscription for username, subscription in subscriptions.items()
+                                 if shard_coordinator.owns(username)}
+                # the online status of the models taken over has been written by the worker which polled them
+                acquired = [username for username in subscriptions if username not in owned_usernames]
+                if acquired:
+                    online = Utils.subscription_index.refresh_online(acquired)
+                    for username in acquired:
+                        if username in online:
+                            subscriptions[username] = (online[username], subscriptions[username][1])
+                        else:
+                            del subscriptions[username]
+                owned_usernames.clear()
+                owned_usernames.update(subscriptions)
+            username_list = poll_scheduler.due(subscriptions.keys())
+        if not username_list:
+            profiler.skip_cycle()
+            time.sleep(min(1.0, poll_scheduler.seconds_until_next()))
+            return
+        cycle_start = time.perf_counter()
+
+        with profiler.stage("status_fetch"):
+            if async_poller is not None:
+                model_instances_dict = async_poller.poll(username_list, attempts=1)
+            else:
+                model_instances_dict = crawl_with_threads(username_list)
+
+        # only download the image of models which just went online for someone who wants a link preview,
+        # when publishing to the outbox the bot downloads them
+        with profiler.stage("image_fetch"):
+            models_needing_image = []
+            for username in username_list if not publish_to_outbox else []:
+                model_instance = model_instances_dict[username]
+                db_online, chatids = subscriptions[username]
+                if not model_instance.online or db_online or model_instance.status in no_preview_statuses:
+                    continue
+                if any(Preferences.get_user_link_preview_preference(chat_id) for chat_id in chatids):
+                    models_needing_image.append(model_instance)
+
+            if async_poller is not None:
+                async_poller.fetch_images(models_needing_image, attempts=2, retry_delay=0)
+            else:
+                fetch_images_with_threads(models_needing_image)
+
+        for model_instance in model_instances_dict.values():
+            poll_scheduler.record(model_instance.username, model_instance.status, model_instance.online)
+            Metrics.models_checked.inc(status="blocked" if model_instance.blocked else model_instance.status)
+            if model_instance.blocked:
+                pass  # the model isn't at fault, concurrency_governor slows down instead
+            elif model_instance.status == "error":
+                if circuit_breaker.record_failure(model_instance.username):
+                    poll_scheduler.postpone(model_instance.username, circuit_breaker.park_time)
+            else:
+                circuit_breaker.record_success(model_instance.username)
+                model_cache.put(model_instance)  # /add and /stream_image reuse the statuses found by the poller
+
+        status_batch = StatusBatch()
+        for username in username_list:
+            model_instance = model_instances_dict[username]
+            if model_instance.status == "error":
+                continue
+            db_online, chatids = subscriptions[username]
+            if model_instance.online and not db_online:
+                status_batch.set_online(username, True, model_instance.status)
+            elif model_instance.online == False and db_online:
+                status_batch.set_online(username, False, model_instance.status)
+
+            if model_instance.status in removal_reasons:
+                status_batch.remove(username, model_instance.status)
+                logging.info(f"{username} has been removed from {len(chatids)} chats because "
+                             f"{removal_reasons[model_instance.status]}")
+
+        # a failed flush raises before anyone is notified, the index is untouched so the next cycle retries
+        with profiler.stage("commit"):
+            rows_written = status_batch.flush(Utils.alchemy_instance, publish=publish_to_outbox)
+            status_batch.apply(Utils.subscription_index)
+        if rows_written:
+            logging.info(f"{rows_written} rows have been written for {len(status_batch)} status changes")
+
+        if not publish_to_outbox:
+            with profiler.stage("notification"):
+                images = {model_instance.username: (model_instance.model_image.getvalue(), model_instance.image_hash)
+                          for model_instance in models_needing_image if model_instance.model_image is not None}
+                events = [(kind, username, status, chatids if chatids is not None else subscriptions[username][1])
+                          for kind, username, status, chatids in status_batch.events()]
+                queue_notifications(events, images)
+
+        Metrics.cycle_seconds.observe(time.perf_counter() - cycle_start)
+        Metrics.models_per_cycle.set(len(username_list))
+
+    # /add and /remove only update the index of the process answering them
+    subscriptions_changed_elsewhere = publish_to_outbox or shard_coordinator is not None
+    last_reconcile = time.time()
     while 1:
         try:
-            update_status()
+            with profiler.cycle():
+                if time.time() - last_reconcile >= reconcile_interval:
+                    with profiler.stage("load"):
+                        Utils.subscription_index.reconcile()
+                    last_reconcile = time.time()
+                elif subscriptions_changed_elsewhere:
+                    with profiler.stage("load"):
+                        Utils.subscription_index.refresh()
+                update_status()
         except Exception as e:
             Utils.handle_exception(e)
 
@@ -725,6 +1160,12 @@ def check_online_status() -> None:
 # endregion
 
 
+broadcaster = Broadcaster(Utils.alchemy_instance, notification_dispatcher,
+                          lambda chatid, message: send_message(chatid, message, bot, automated=True),
+                          report_broadcast_progress, argparse_args["broadcast_chunk_size"],
+                          argparse_args["notification_workers"] * 2)
+profiler = Profiler(bot_path, lambda chatid, summary: chatid is not None and send_message(chatid, summary, bot))
+
 dispatcher.add_handler(CommandHandler(('start', 'help'), start))
 dispatcher.add_handler(CommandHandler('add', add))
 dispatcher.add_handler(CommandHandler('remove', remove))
@@ -739,14 +1180,118 @@ dispatcher.add_handler(CallbackQueryHandler(notifications_sound_callback_update_
                                             pattern='notifications_sound_callback_True|notifications_sound_callback_False'))
 dispatcher.add_handler(CallbackQueryHandler(settings, pattern='settings_menu'))
 dispatcher.add_handler(CallbackQueryHandler(view_stream_image_callback, pattern='view_stream_image_callback_'))
+dispatcher.add_handler(CallbackQueryHandler(list_page_callback, pattern='list_page_'))
 dispatcher.add_handler(CommandHandler('authorize_admin', authorize_admin))
 dispatcher.add_handler(CommandHandler('send_message_to_everyone', send_message_to_everyone))
 dispatcher.add_handler(CommandHandler('active_users', active_users))
 dispatcher.add_handler(CommandHandler('active_models', active_models))
+dispatcher.add_handler(CommandHandler('cache_stats', cache_stats))
+dispatcher.add_handler(CommandHandler('model_failures', model_failures))
+dispatcher.add_handler(CommandHandler('profile', profile))
+
+# handlers which wait for chaturbate run on the dispatcher's worker pool,
+# so they don't hold up the updates of the other users
+async_handlers = {"add", "stream_image", "view_stream_image_callback"}
+for handler in dispatcher.handlers[0]:  # every handler is timed by its callback name
+    callback_name = handler.callback.__name__
+    handler.callback = Metrics.timed_handler(callback_name, handler.callback)
+    handler.callback = profiler.profiled_handler(callback_name, handler.callback)
+    if callback_name in async_handlers:
+        handler.callback = run_async(handler.callback)
+
+
+def main(role: str = "all") -> None:
+    """
+    Starts the bot
+
+    :param role: "bot" answers the commands and sends the notifications published by the pollers,
+                 "poller" checks the models and publishes their status changes, "all" does both in this process
+    """
+    polls = role in ("all", "poller")
+    notifies = role in ("all", "bot")
+
+    Metrics.Gauge("cache_requests", "Cache lookups, by cache and result", ("cache", "result"),
+                  function=lambda: {(name, result): cache.stats()[result]
+                                    for name, cache in (("preferences", Preferences.preferences_cache),
+                                                        ("admin", Utils.admin_cache),
+                                                        ("photo_file_id", Utils.photo_file_ids))
+                                    for result in ("hits", "misses")})
+    if role != "poller":
+        Metrics.Gauge("update_queue_size", "Telegram updates waiting for the dispatcher",
+                      function=dispatcher.update_queue.qsize)
+    if notifies:
+        Metrics.Gauge("notification_queue_size", "Notifications waiting to be sent",
+                      function=notification_dispatcher.qsize)
+    if polls:
+        Utils.subscription_index.load()
+        Metrics.Gauge("followed_models", "Models followed by at least one user",
+                      function=lambda: len(Utils.subscription_index.usernames()))
+        Metrics.Gauge("failing_models", "Models whose last checks failed",
+                      function=lambda: len(circuit_breaker.failure_counts()))
+        Metrics.Gauge("parked_models", "Models not checked because they failed too often",
+                      function=lambda: len(circuit_breaker.parked()))
+        if shard_coordinator is not None:
+            Metrics.Gauge("poller_workers", "Pollers sharing the models",
+                          function=lambda: len(shard_coordinator.workers()))
+        if concurrency_governor is not None:
+            Metrics.Gauge("concurrency_limit", "Status requests allowed in flight by the governor",
+                          function=lambda: concurrency_governor.stats()["limit"])
+            Metrics.Gauge("concurrency_in_flight", "Status requests in flight",
+                          function=lambda: concurrency_governor.stats()["in_flight"])
+            Metrics.Gauge("concurrency_latency_seconds", "Moving average of the status latency seen by the governor",
+                          function=lambda: concurrency_governor.stats()["latency"] or 0)
+            Metrics.Gauge("concurrency_baseline_seconds", "The uncongested status latency estimated by the governor",
+                          function=lambda: concurrency_governor.stats()["baseline"] or 0)
+            Metrics.Gauge("concurrency_blocks", "Blocks by chaturbate seen by the governor since startup",
+                          function=lambda: concurrency_governor.stats()["blocks"])
+
+    if argparse_args["metrics_port"]:
+        Metrics.instrument_engine(Utils.alchemy_instance.engine)
+        Metrics.start_http_server(argparse_args["metrics_port"], argparse_args["metrics_address"])
+
+    if polls and argparse_args["profile_cycles"]:
+        profiler.start("cycles", argparse_args["profile_cycles"])
+    if role != "poller" and argparse_args["profile_handlers"]:
+        profiler.start("handlers", argparse_args["profile_handlers"])
+
+    if notifies:
+        logging.info('Starting notification dispatcher threads...')
+        notification_dispatcher.start()
+        broadcaster.resume()
+
+    # the sharded pollers of the other processes may be poller.py, publishing their status changes
+    if role == "bot" or (notifies and shard_coordinator is not None):
+        logging.info('Starting outbox consumer thread...')
+        OutboxConsumer(Utils.alchemy_instance, handle_outbox_events, argparse_args["outbox_poll_interval"]).start()
+
+    if polls and shard_coordinator is not None:
+        logging.info(f'Joining the pollers as {shard_coordinator.worker_id}...')
+        shard_coordinator.start()
+        atexit.register(shard_coordinator.stop)
+
+    if role == "poller":
+        logging.info('Starting models checking, commands are answered by the bot...')
+        check_online_status(publish_to_outbox=True)
+        return
+
+    if polls:
+        logging.info('Starting models checking thread...')
+        threading.Thread(target=check_online_status, daemon=True).start()
+
+    if argparse_args["webhook_url"]:
+        url_path = argparse_args["webhook_path"] if argparse_args["webhook_path"] is not None else argparse_args["key"]
+        webhook_url = argparse_args["webhook_url"].rstrip("/") + "/" + url_path
+        updater.start_webhook(listen=argparse_args["webhook_listen"], port=argparse_args["webhook_port"],
+                              url_path=url_path, cert=argparse_args["webhook_cert"], key=argparse_args["webhook_key"],
+                              webhook_url=webhook_url)
+        if argparse_args["webhook_cert"] is None or argparse_args["webhook_key"] is None:
+            bot.set_webhook(webhook_url)  # the updater registers the webhook only when it terminates tls itself
+        logging.info(f'Serving the telegram webhook on port {argparse_args["webhook_port"]}')
+    else:
+        logging.info('Starting telegram polling thread...')
+        updater.start_polling()
+    updater.idle()
 
-logging.info('Starting models checking thread...')
-threading.Thread(target=check_online_status, daemon=True).start()
 
-logging.info('Starting telegram polling thread...')
-updater.start_polling()
-updater.idle()
+if __name__ == "__main__":
+    main(argparse_args["role"])
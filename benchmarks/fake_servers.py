@@ -0,0 +1,268 @@
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+ONLINE_STATUSES = ("public", "private", "away", "hidden")
+# a tiny valid jpeg, the bot only forwards the bytes
+FAKE_JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f141d1a1f1e1d"
+    "1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100ffc4001f000001050101"
+    "0101010100000000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d01020300041105122131410613"
+    "516107227114328191a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a434445464748494a53545556"
+    "5758595a636465666768696a737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2"
+    "c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda0008010100003f00fbd3ffd9")
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):  # http.server.ThreadingHTTPServer needs python 3.7
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeModel:
+
+    def __init__(self, rng: random.Random, online_fraction: float, status_mix: Dict[str, float], mean_session: float,
+                 now: float):
+        """
+        A model which goes online and offline at exponentially distributed intervals
+
+        :param rng: The random generator, seeded so that runs are comparable
+        :param online_fraction: The probability of being online at any time
+        :param status_mix: Online status -> weight, the status used while the model is online
+        :param mean_session: The mean number of seconds of an online session
+        :param now: The start of the benchmark
+        """
+        self.rng = rng
+        self.online_status = rng.choices(list(status_mix), weights=list(status_mix.values()))[0]
+        self.mean_online = mean_session
+        self.mean_offline = mean_session * (1 - online_fraction) / max(online_fraction, 1e-9)
+        self.online = rng.random() < online_fraction
+        self.last_change = None  # None until the model changes status after the start
+        self.next_change = now + rng.expovariate(1 / (self.mean_online if self.online else self.mean_offline))
+
+    def status(self, now: float) -> str:
+        while now >= self.next_change:
+            self.online = not self.online
+            self.last_change = self.next_change
+            self.next_change += self.rng.expovariate(1 / (self.mean_online if self.online else self.mean_offline))
+        return self.online_status if self.online else "offline"
+
+
+class FakeChaturbate:
+
+    def __init__(self, models: List[str], latency: float = 0.05, error_rate: float = 0.0, block_rate: float = 0.0,
+                 online_fraction: float = 0.2, status_mix: Dict[str, float] = None, mean_session: float = 60,
+                 seed: int = 0):
+        """
+        Serves /api/chatvideocontext/<username> and /ri/<username>.jpg like chaturbate does
+
+        :param models: The usernames the server knows, the others are answered as deleted rooms
+        :param latency: The mean seconds before every response, exponentially distributed
+        :param error_rate: The fraction of requests answered with a 500
+        :param block_rate: The fraction of requests answered with a 429
+        :param online_fraction: The fraction of time every model is online
+        :param status_mix: Online status -> weight, defaults to public only
+        :param mean_session: The mean seconds a model stays online
+        :param seed: The seed of every random choice
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.block_rate = block_rate
+        self.started = time.time()
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        status_mix = status_mix or {"public": 1.0}
+        self.models = {username: FakeModel(random.Random(f"{seed}-{username}"), online_fraction, status_mix,
+                                           mean_session, self.started) for username in models}
+        self.requests = {"status": 0, "image": 0, "errors": 0, "blocks": 0}
+        self.server = None
+
+    def last_change(self, username: str):
+        """
+        :param username: The model's username
+        :return: (online, time of the last status change), the time is None if it never changed
+        """
+        with self._lock:
+            model = self.models[username]
+            model.status(time.time())
+            return model.online, model.last_change
+
+    def start(self, address: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        :return: The base url of the running server
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real servers
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _Server((address, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="fake-chaturbate").start()
+        return f"http://{address}:{self.server.server_port}"
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        path = urlsplit(request.path).path
+        with self._lock:
+            roll = self.rng.random()
+            delay = self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0
+        time.sleep(delay)
+
+        match = re.fullmatch(r"/api/chatvideocontext/([^/]+)/?", path)
+        if match is None:
+            match = re.fullmatch(r"/ri/([^/]+)\.jpg", path)
+            if match is None:
+                _reply(request, 404, b"not found")
+                return
+            with self._lock:
+                self.requests["image"] += 1
+            _reply(request, 200, FAKE_JPEG, "image/jpeg")
+            return
+
+        username = match.group(1)
+        with self._lock:
+            self.requests["status"] += 1
+            if roll < self.block_rate:
+                self.requests["blocks"] += 1
+                code = 429
+            elif roll < self.block_rate + self.error_rate:
+                self.requests["errors"] += 1
+                code = 500
+            else:
+                code = 200
+            model = self.models.get(username)
+            status = model.status(time.time()) if model is not None else None
+
+        if code == 429:
+            _reply(request, 429, b"<title>Just a moment...</title>", "text/html")
+        elif code == 500:
+            _reply(request, 500, b"internal server error", "text/html")
+        elif status is None:
+            _reply(request, 401, json.dumps({"detail": "Room is deleted."}).encode())
+        else:
+            _reply(request, 200, json.dumps({"room_status": status, "broadcaster_username": username}).encode())
+
+
+class FakeTelegram:
+    MESSAGE_PATTERN = re.compile(r"(\S+) is now (?:<b>)?(online|offline)")
+
+    def __init__(self, latency: float = 0.0, on_notification=None, on_message=None):
+        """
+        Answers the bot api methods used by the bot and records every notification
+
+        :param latency: The seconds before every response
+        :param on_notification: Called with (username, online, chat_id, time) for every online/offline notification
+        :param on_message: Called with (method, chat_id, text, time) for every message or photo sent by the bot
+        """
+        self.latency = latency
+        self.on_notification = on_notification
+        self.on_message = on_message
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.calls: Dict[str, int] = {}
+        self.server = None
+
+    def start(self, address: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        :return: The base url to give to the bot, the token is appended to it
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def do_POST(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _Server((address, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="fake-telegram").start()
+        return f"http://{address}:{self.server.server_port}/bot"
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    def _handle(self, request: BaseHTTPRequestHandler) -> None:
+        received = time.time()
+        method = urlsplit(request.path).path.rsplit("/", 1)[-1]
+        body = request.rfile.read(int(request.headers.get("Content-Length") or 0))
+        params = _parse_params(request.headers.get("Content-Type", ""), body)
+        params.update({key: values[0] for key, values in parse_qs(urlsplit(request.path).query).items()})
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self._message_id += 1
+            message_id = self._message_id
+
+        if method == "getUpdates":
+            time.sleep(min(float(params.get("timeout") or 0), 1.0))
+            _reply_json(request, [])
+            return
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "benchmark", "username": "benchmark_bot"}
+        elif method == "getMyCommands":
+            result = []
+        elif method in ("sendMessage", "sendPhoto"):
+            chat_id = str(params.get("chat_id"))
+            text = str(params.get("text") or params.get("caption") or "")
+            result = {"message_id": message_id, "date": int(received), "chat": {"id": int(chat_id), "type": "private"}}
+            if method == "sendPhoto":
+                result["photo"] = [{"file_id": f"photo-{message_id}", "file_unique_id": f"photo-{message_id}",
+                                    "width": 1, "height": 1}]
+            else:
+                result["text"] = text
+            if self.on_message is not None:
+                self.on_message(method, chat_id, text, received)
+            match = self.MESSAGE_PATTERN.match(text)
+            if match is not None and self.on_notification is not None:
+                self.on_notification(match.group(1), match.group(2) == "online", chat_id, received)
+        else:  # sendChatAction, deleteWebhook, answerCallbackQuery...
+            result = True
+        _reply_json(request, result)
+
+
+def _parse_params(content_type: str, body: bytes) -> dict:
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+    if content_type.startswith("multipart/form-data"):
+        params = {}
+        for name, value in re.findall(rb'name="([^"]+)"(?:; filename="[^"]*")?\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--',
+                                      body, re.S):
+            if name != b"photo":
+                params[name.decode()] = value.decode(errors="replace")
+        return params
+    return {}
+
+
+def _reply(request: BaseHTTPRequestHandler, code: int, body: bytes, content_type: str = "application/json") -> None:
+    request.send_response(code)
+    request.send_header("Content-Type", content_type)
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
+
+
+def _reply_json(request: BaseHTTPRequestHandler, result) -> None:
+    _reply(request, 200, json.dumps({"ok": True, "result": result}).encode())
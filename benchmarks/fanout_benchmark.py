@@ -0,0 +1,75 @@
+"""
+Compares how fast the notifications of models followed by many chats are sent with the sqlite and postgres backends
+
+Every model is followed by every chat, so each status change fans out to --followers notifications. The same run is
+repeated on a temporary sqlite file and, if given, on an empty postgres database:
+
+    $ python3 benchmarks/fanout_benchmark.py --followers 1000 --postgres postgresql://127.0.0.1:5432/benchmark
+
+The telegram rate limits of the bot are lifted and the models are checked every second, so the time spent in the
+database and not the token buckets or the poll schedule bounds the fan-out. The arguments after -- are passed to the bot and override these defaults
+"""
+import argparse
+import json
+import sys
+
+from poller_benchmark import print_report, run
+
+DEFAULT_BOT_ARGS = ["--global-rate-limit", "1000000", "--chat-rate-limit", "1000000", "--notification-workers", "16",
+                    "--min-poll-interval", "1"]
+COMPARED_KEYS = ("notifications", "notification_delay_p50", "notification_delay_p99", "mean_cycle_seconds",
+                 "cycles_per_second", "db_statements", "peak_rss_kb")
+
+
+def run_backend(options, database_string, bot_args: list) -> dict:
+    poller_options = argparse.Namespace(
+        models=options.models, subscriptions=options.models * options.followers, chats=options.followers,
+        duration=options.duration, latency=options.latency, telegram_latency=options.telegram_latency,
+        error_rate=0.0, block_rate=0.0, online_fraction=0.5, status_mix="public=1", mean_session=options.mean_session,
+        link_preview=options.link_preview, database_string=database_string, seed=options.seed)
+    return run(poller_options, DEFAULT_BOT_ARGS + bot_args)
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    bot_args = []
+    if "--" in argv:
+        bot_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--models", type=int, default=20, help="Number of fake models. Default = 20")
+    ap.add_argument("--followers", type=int, default=500, help="Chats following every model. Default = 500")
+    ap.add_argument("--duration", type=float, default=60, help="Seconds to measure every backend. Default = 60")
+    ap.add_argument("--mean-session", type=float, default=20,
+                    help="Mean seconds a model stays online or offline. Default = 20")
+    ap.add_argument("--latency", type=float, default=0.05,
+                    help="Mean latency of the fake chaturbate, in seconds. Default = 0.05")
+    ap.add_argument("--telegram-latency", type=float, default=0.0,
+                    help="Latency of the fake telegram api, in seconds. Default = 0")
+    ap.add_argument("--link-preview", type=float, default=0.0,
+                    help="Fraction of chats with link preview enabled. Default = 0")
+    ap.add_argument("--postgres", type=str, default=None,
+                    help="An empty postgres database to compare against, only sqlite runs without it")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed. Default = 0")
+    ap.add_argument("--output", type=str, default=None, help="Write both reports to this json file")
+    options = ap.parse_args(argv)
+
+    reports = {"sqlite": run_backend(options, None, bot_args)}  # None is a temporary sqlite file
+    if options.postgres:
+        reports["postgres"] = run_backend(options, options.postgres, bot_args)
+
+    for backend, report in reports.items():
+        report["commit"] = f"{backend} at {report['commit']}"
+    print("sqlite:")
+    print_report({key: reports["sqlite"][key] for key in COMPARED_KEYS})
+    if "postgres" in reports:
+        print("postgres:")
+        print_report({key: reports["postgres"][key] for key in COMPARED_KEYS}, reports["sqlite"])
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(reports, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
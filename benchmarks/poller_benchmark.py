@@ -0,0 +1,282 @@
+"""
+Runs the bot against local fake chaturbate and telegram servers and reports how fast it polls and notifies
+
+Everything runs offline on localhost, so the numbers of two commits can be compared:
+
+    $ python3 benchmarks/poller_benchmark.py --models 2000 --subscriptions 10000 --duration 120 --output before.json
+    $ python3 benchmarks/poller_benchmark.py --models 2000 --subscriptions 10000 --duration 120 --compare before.json
+
+The arguments after -- are passed to the bot, e.g. -- --poller asyncio --concurrency 200
+"""
+import argparse
+import json
+import random
+import re
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fake_servers import FakeChaturbate, FakeTelegram  # noqa: E402
+from modules.alchemy import Alchemy, ChaturbateModel, PreferenceUser, Subscription  # noqa: E402
+
+SAMPLE_PATTERN = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+
+def parse_status_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        status, weight = item.split("=")
+        mix[status.strip()] = float(weight)
+    return mix
+
+
+def seed_database(database_string: str, usernames: list, subscriptions: int, chats: int, link_preview: float,
+                  rng: random.Random) -> None:
+    """
+    Fills the database with subscriptions spread over the models with a zipf like popularity
+
+    :param database_string: The database to fill, it must be empty
+    :param usernames: The usernames of the models
+    :param subscriptions: The number of (username, chat) rows
+    :param chats: The number of distinct chats
+    :param link_preview: The fraction of chats with link preview enabled
+    :param rng: The random generator
+    """
+    alchemy_instance = Alchemy(database_string)
+    weights = [1 / (rank + 1) for rank in range(len(usernames))]
+    rows = set()
+    while len(rows) < min(subscriptions, len(usernames) * chats):
+        username = rng.choices(usernames, weights=weights)[0]
+        rows.add((username, 100000 + rng.randrange(chats)))
+
+    session = alchemy_instance.session
+    models = {username: ChaturbateModel(username=username, online=False)
+              for username in sorted({username for username, chat_id in rows})}
+    session.add_all(models.values())
+    session.flush()  # assigns the ids
+    session.bulk_save_objects([Subscription(model_id=models[username].id, chat_id=chat_id)
+                               for username, chat_id in rows])
+    session.bulk_save_objects([PreferenceUser(chat_id=100000 + chat, link_preview=int(rng.random() < link_preview),
+                                              notifications_sound=True) for chat in range(chats)])
+    session.commit()
+    alchemy_instance.engine.dispose()
+
+
+def scrape_metrics(port: int) -> dict:
+    """
+    :return: (name, labels) -> value of every sample exported by the bot
+    """
+    samples = {}
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            match = SAMPLE_PATTERN.match(line)
+            if match is not None:
+                samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples
+
+
+def metric_sum(samples: dict, name: str, label_filter: str = "") -> float:
+    return sum(value for (sample_name, labels), value in samples.items()
+               if sample_name == name and label_filter in labels)
+
+
+def metric_by_label(samples: dict, name: str, label: str) -> dict:
+    values = {}
+    for (sample_name, labels), value in samples.items():
+        match = re.search(label + r'="([^"]*)"', labels)
+        if sample_name == name and match is not None:
+            values[match.group(1)] = values.get(match.group(1), 0) + value
+    return values
+
+
+def peak_rss(pid: int) -> int:
+    """
+    :return: The peak resident memory of a running process in kB, 0 where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(options, bot_args: list) -> dict:
+    rng = random.Random(options.seed)
+    usernames = [f"benchmark_model_{i}" for i in range(options.models)]
+    workdir = Path(tempfile.mkdtemp(prefix="chaturbatebot-benchmark-"))
+    database_string = options.database_string or f"sqlite:///{workdir / 'benchmark.db'}"
+    seed_database(database_string, usernames, options.subscriptions, options.chats, options.link_preview, rng)
+
+    delays = []
+    initial_notifications = [0]
+    stale_notifications = [0]
+    chaturbate = FakeChaturbate(usernames, options.latency, options.error_rate, options.block_rate,
+                                options.online_fraction, parse_status_mix(options.status_mix), options.mean_session,
+                                options.seed)
+
+    def on_notification(username, online, chat_id, received):
+        current_online, last_change = chaturbate.last_change(username)
+        if last_change is None:
+            initial_notifications[0] += 1  # the status the model had when the benchmark started
+        elif current_online != online:
+            stale_notifications[0] += 1  # the model changed again before the notification was sent
+        else:
+            delays.append(received - last_change)
+
+    telegram = FakeTelegram(options.telegram_latency, on_notification)
+    chaturbate_url = chaturbate.start()
+    telegram_url = telegram.start()
+    metrics_port = free_port()
+
+    command = [sys.executable, str(ROOT / "ChaturbateBot.py"), "-k", "123456:benchmark",
+               "--database-string", database_string, "--working-folder", str(workdir),
+               "--logging-file", str(workdir / "benchmark.log"), "--enable-logging", "False",
+               "--status-url", chaturbate_url + "/api/chatvideocontext/{username}",
+               "--image-url", chaturbate_url + "/ri/{username}.jpg", "--telegram-url", telegram_url,
+               "--metrics-port", str(metrics_port)] + bot_args
+    print(f"Seeded {options.subscriptions} subscriptions to {options.models} models in {database_string}")
+    print("Running " + " ".join(command[1:]))
+    bot_process = subprocess.Popen(command, cwd=str(workdir))
+
+    rss = 0
+    samples = {}
+    started = time.time()
+    try:
+        # wait for the metrics endpoint before starting the clock
+        while True:
+            if bot_process.poll() is not None:
+                raise RuntimeError(f"The bot exited with code {bot_process.returncode}, see {workdir}")
+            try:
+                first_samples = scrape_metrics(metrics_port)
+                break
+            except OSError:
+                time.sleep(0.2)
+        started = time.time()
+        while time.time() - started < options.duration:
+            time.sleep(1)
+            rss = max(rss, peak_rss(bot_process.pid))
+            if bot_process.poll() is not None:
+                raise RuntimeError(f"The bot exited with code {bot_process.returncode}, see {workdir}")
+        samples = scrape_metrics(metrics_port)
+        rss = max(rss, peak_rss(bot_process.pid))
+    finally:
+        elapsed = time.time() - started
+        bot_process.send_signal(signal.SIGINT)
+        try:
+            bot_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            bot_process.kill()
+            bot_process.wait()
+        chaturbate.stop()
+        telegram.stop()
+    rss = max(rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    cycles = metric_sum(samples, "chaturbatebot_poll_cycle_seconds_count") - \
+        metric_sum(first_samples, "chaturbatebot_poll_cycle_seconds_count")
+    cycle_count = metric_sum(samples, "chaturbatebot_poll_cycle_seconds_count")
+    cycle_seconds = metric_sum(samples, "chaturbatebot_poll_cycle_seconds_sum")
+    checks = metric_sum(samples, "chaturbatebot_models_checked_total")
+    return {
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(ROOT), stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout.strip(),
+        "models": options.models,
+        "subscriptions": options.subscriptions,
+        "seconds": round(elapsed, 1),
+        "cycles_per_second": cycles / elapsed if elapsed else 0,
+        "mean_cycle_seconds": cycle_seconds / cycle_count if cycle_count else None,
+        "checks_per_second": checks / elapsed if elapsed else 0,
+        "notification_delay_p50": percentile(delays, 0.5),
+        "notification_delay_p99": percentile(delays, 0.99),
+        "notifications": len(delays),
+        "initial_notifications": initial_notifications[0],
+        "stale_notifications": stale_notifications[0],
+        "chaturbate_requests": dict(chaturbate.requests),
+        "telegram_calls": dict(telegram.calls),
+        "http_responses": metric_by_label(samples, "chaturbatebot_http_responses_total", "code"),
+        "db_statements": metric_by_label(samples, "chaturbatebot_db_statements_total", "statement"),
+        "checks_by_status": metric_by_label(samples, "chaturbatebot_models_checked_total", "status"),
+        "peak_rss_kb": rss,
+    }
+
+
+def print_report(report: dict, baseline: dict = None) -> None:
+    for key, value in report.items():
+        line = f"{key:>24}: {value:.4f}" if isinstance(value, float) else f"{key:>24}: {value}"
+        if baseline is not None and isinstance(value, (int, float)) and isinstance(baseline.get(key), (int, float)) \
+                and baseline[key]:
+            line += f"  ({(value - baseline[key]) / baseline[key] * 100:+.1f}% vs {baseline.get('commit')})"
+        print(line)
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    bot_args = []
+    if "--" in argv:
+        bot_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--models", type=int, default=1000, help="Number of fake models. Default = 1000")
+    ap.add_argument("--subscriptions", type=int, default=5000, help="Number of subscriptions. Default = 5000")
+    ap.add_argument("--chats", type=int, default=1000, help="Number of distinct chats. Default = 1000")
+    ap.add_argument("--duration", type=float, default=60, help="Seconds to measure. Default = 60")
+    ap.add_argument("--latency", type=float, default=0.05,
+                    help="Mean latency of the fake chaturbate, in seconds. Default = 0.05")
+    ap.add_argument("--telegram-latency", type=float, default=0.0,
+                    help="Latency of the fake telegram api, in seconds. Default = 0")
+    ap.add_argument("--error-rate", type=float, default=0.01, help="Fraction of 500 responses. Default = 0.01")
+    ap.add_argument("--block-rate", type=float, default=0.0, help="Fraction of 429 responses. Default = 0")
+    ap.add_argument("--online-fraction", type=float, default=0.2,
+                    help="Fraction of time a model is online. Default = 0.2")
+    ap.add_argument("--status-mix", type=str, default="public=0.85,private=0.05,away=0.05,hidden=0.05",
+                    help="Weights of the statuses of online models. Default = public=0.85,private=0.05,away=0.05,"
+                         "hidden=0.05")
+    ap.add_argument("--mean-session", type=float, default=120,
+                    help="Mean seconds a model stays online. Default = 120")
+    ap.add_argument("--link-preview", type=float, default=0.5,
+                    help="Fraction of chats with link preview enabled. Default = 0.5")
+    ap.add_argument("--database-string", type=str, default=None,
+                    help="An empty database to use instead of a temporary sqlite file")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed. Default = 0")
+    ap.add_argument("--output", type=str, default=None, help="Write the report to this json file")
+    ap.add_argument("--compare", type=str, default=None, help="A json report to compare against")
+    options = ap.parse_args(argv)
+
+    report = run(options, bot_args)
+    baseline = None
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Floods the bot's webhook with concurrent commands and reports how long users wait for an answer
+
+The bot runs in webhook mode against local fake chaturbate and telegram servers, every update comes from a different
+chat and its latency is the time until the bot sends the first message to that chat:
+
+    $ python3 benchmarks/webhook_benchmark.py --updates 500 --senders 50 -- --dispatcher-workers 16
+
+The arguments after -- are passed to the bot
+"""
+import argparse
+import itertools
+import json
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from fake_servers import FakeChaturbate, FakeTelegram
+from poller_benchmark import ROOT, free_port, metric_by_label, peak_rss, percentile, print_report, scrape_metrics, \
+    seed_database
+
+WEBHOOK_PATH = "benchmark-webhook"
+
+
+def build_update(update_id: int, chat_id: int, command: str) -> dict:
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private", "first_name": "benchmark"},
+                        "from": {"id": chat_id, "is_bot": False, "first_name": "benchmark"},
+                        "text": command,
+                        "entities": [{"type": "bot_command", "offset": 0, "length": len(command.split(" ")[0])}]}}
+
+
+def post_update(webhook_url: str, update: dict) -> None:
+    request = urllib.request.Request(webhook_url, data=json.dumps(update).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+
+
+def run(options, bot_args: list) -> dict:
+    rng = random.Random(options.seed)
+    usernames = [f"benchmark_model_{i}" for i in range(options.models)]
+    workdir = Path(tempfile.mkdtemp(prefix="chaturbatebot-benchmark-"))
+    database_string = options.database_string or f"sqlite:///{workdir / 'benchmark.db'}"
+    seed_database(database_string, usernames, options.subscriptions, max(1, options.subscriptions // 5), 0.5, rng)
+
+    lock = threading.Lock()
+    sent_at = {}  # chat_id -> time the update was posted
+    latencies = []
+    replied = threading.Event()
+
+    def on_message(method, chat_id, text, received):
+        with lock:
+            posted = sent_at.pop(chat_id, None)
+            if posted is not None:
+                latencies.append(received - posted)
+                if len(latencies) == options.updates:
+                    replied.set()
+
+    chaturbate = FakeChaturbate(usernames, options.latency, 0.0, 0.0, seed=options.seed)
+    telegram = FakeTelegram(options.telegram_latency, on_message=on_message)
+    chaturbate_url = chaturbate.start()
+    telegram_url = telegram.start()
+    metrics_port = free_port()
+    webhook_port = free_port()
+
+    command = [sys.executable, str(ROOT / "ChaturbateBot.py"), "-k", "123456:benchmark",
+               "--database-string", database_string, "--working-folder", str(workdir),
+               "--logging-file", str(workdir / "benchmark.log"), "--enable-logging", "False",
+               "--status-url", chaturbate_url + "/api/chatvideocontext/{username}",
+               "--image-url", chaturbate_url + "/ri/{username}.jpg", "--telegram-url", telegram_url,
+               "--metrics-port", str(metrics_port), "--webhook-url", f"http://127.0.0.1:{webhook_port}",
+               "--webhook-listen", "127.0.0.1", "--webhook-port", str(webhook_port), "--webhook-path", WEBHOOK_PATH,
+               "-l", "0"] + bot_args
+    print("Running " + " ".join(command[1:]))
+    bot_process = subprocess.Popen(command, cwd=str(workdir))
+
+    commands = options.commands.split(",")
+    webhook_url = f"http://127.0.0.1:{webhook_port}/{WEBHOOK_PATH}"
+    samples = {}
+    rss = 0
+    try:
+        while telegram.calls.get("setWebhook", 0) == 0:  # the webhook server is up once it registered itself
+            if bot_process.poll() is not None:
+                raise RuntimeError(f"The bot exited with code {bot_process.returncode}, see {workdir}")
+            time.sleep(0.2)
+        time.sleep(1)
+
+        update_ids = itertools.count(1)
+
+        def send(i: int) -> None:
+            chat_id = 500000 + i
+            text = commands[i % len(commands)].format(model=usernames[rng.randrange(len(usernames))])
+            update = build_update(next(update_ids), chat_id, text)
+            with lock:
+                sent_at[str(chat_id)] = time.time()
+            post_update(webhook_url, update)
+            if options.rate:
+                time.sleep(options.senders / options.rate)
+
+        started = time.time()
+        with ThreadPoolExecutor(options.senders) as executor:
+            list(executor.map(send, range(options.updates)))
+        posted = time.time()
+        replied.wait(options.timeout)
+        finished = time.time()
+        samples = scrape_metrics(metrics_port)
+        rss = peak_rss(bot_process.pid)
+    finally:
+        bot_process.send_signal(signal.SIGINT)
+        try:
+            bot_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            bot_process.kill()
+            bot_process.wait()
+        chaturbate.stop()
+        telegram.stop()
+
+    handler_counts = metric_by_label(samples, "chaturbatebot_handler_seconds_count", "handler")
+    handler_sums = metric_by_label(samples, "chaturbatebot_handler_seconds_sum", "handler")
+    return {
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(ROOT), stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout.strip(),
+        "updates": options.updates,
+        "answered": len(latencies),
+        "post_seconds": round(posted - started, 2),
+        "updates_per_second": len(latencies) / (finished - started),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies) if latencies else None,
+        "mean_handler_seconds": {handler: handler_sums[handler] / count
+                                 for handler, count in handler_counts.items() if count},
+        "chaturbate_requests": dict(chaturbate.requests),
+        "telegram_calls": dict(telegram.calls),
+        "peak_rss_kb": rss,
+    }
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    bot_args = []
+    if "--" in argv:
+        bot_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--updates", type=int, default=300, help="Number of updates to send. Default = 300")
+    ap.add_argument("--senders", type=int, default=30, help="Updates posted concurrently. Default = 30")
+    ap.add_argument("--rate", type=float, default=0, help="Updates per second, 0 = as fast as possible. Default = 0")
+    ap.add_argument("--commands", type=str, default="/add {model},/stream_image {model},/list,/start",
+                    help="Comma separated commands sent in turn, {model} is replaced by a random model. "
+                         "Default = /add {model},/stream_image {model},/list,/start")
+    ap.add_argument("--models", type=int, default=100, help="Number of fake models. Default = 100")
+    ap.add_argument("--subscriptions", type=int, default=0,
+                    help="Subscriptions in the database, to add poll load. Default = 0")
+    ap.add_argument("--latency", type=float, default=0.2,
+                    help="Mean latency of the fake chaturbate, in seconds. Default = 0.2")
+    ap.add_argument("--telegram-latency", type=float, default=0.0,
+                    help="Latency of the fake telegram api, in seconds. Default = 0")
+    ap.add_argument("--timeout", type=float, default=120, help="Seconds to wait for the answers. Default = 120")
+    ap.add_argument("--database-string", type=str, default=None,
+                    help="An empty database to use instead of a temporary sqlite file")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed. Default = 0")
+    ap.add_argument("--output", type=str, default=None, help="Write the report to this json file")
+    ap.add_argument("--compare", type=str, default=None, help="A json report to compare against")
+    options = ap.parse_args(argv)
+
+    report = run(options, bot_args)
+    baseline = None
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the bot role of ChaturbateBot, see ChaturbateBot.py --help for the arguments
+"""
+from ChaturbateBot import main
+
+if __name__ == "__main__":
+    main("bot")
@@ -0,0 +1,200 @@
+import asyncio
+import datetime
+import io
+import logging
+import threading
+import time
+from typing import Dict, Iterable
+
+import aiohttp
+
+from modules import ImagePipeline
+from modules import Model as ModelModule
+from modules.ConcurrencyGovernor import ConcurrencyGovernor
+from modules.Model import Model
+
+
+class _GovernedSemaphore:
+
+    def __init__(self, governor: ConcurrencyGovernor):
+        """
+        asyncio semaphore whose size is the current limit of the governor
+        """
+        self.governor = governor
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.governor.limit)
+            self._in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+
+class AsyncPoller:
+
+    def __init__(self, concurrency: int = 100, governor: ConcurrencyGovernor = None):
+        """
+        Checks many models concurrently using asyncio, producing the same Model instances as the threaded crawl
+
+        :param concurrency: The maximum number of http requests in flight at the same time
+        :param governor: Adapts the number of status requests in flight to what chaturbate tolerates
+        """
+        self.concurrency = concurrency
+        self.governor = governor
+        self.loop = asyncio.new_event_loop()
+        self._lock = threading.Lock()  # the loop runs one call at a time, close() can come from another thread
+        self._session = None  # kept open between cycles so connections are reused
+
+    def poll(self, usernames: Iterable[str], attempts: int = 5, retry_delay: float = 3) -> Dict[str, Model]:
+        """
+        Updates the status of every username
+
+        :param usernames: The usernames to check
+        :param attempts: How many times a request is tried before setting the status to 'error'
+        :param retry_delay: Seconds to wait between attempts
+        :return: A dict of username -> Model
+        """
+        with self._lock:
+            return self.loop.run_until_complete(self._poll(list(usernames), attempts, retry_delay))
+
+    def fetch_images(self, model_instances: Iterable[Model], attempts: int = 5, retry_delay: float = 1) -> None:
+        """
+        Downloads the stream image of every model concurrently, model_image is set to None on failure
+
+        :param model_instances: The models to download the image of
+        :param attempts: How many times a download is tried
+        :param retry_delay: Seconds to wait between attempts
+        """
+        with self._lock:
+            self.loop.run_until_complete(self._fetch_images(list(model_instances), attempts, retry_delay))
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            settings = ModelModule.http_settings
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=settings["keepalive"])
+            timeout = aiohttp.ClientTimeout(sock_connect=settings["connect_timeout"], sock_read=settings["read_timeout"])
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=ModelModule.HEADERS)
+        return self._session
+
+    def close(self, timeout: float = 5) -> None:
+        """
+        Closes the http session and its connections, a later call opens a new one
+
+        :param timeout: Seconds to wait for the running poll to finish
+        """
+        if not self._lock.acquire(timeout=timeout):
+            logging.warning("The asyncio poller is still polling, its http session is left open")
+            return
+        try:
+            if self._session is not None and not self._session.closed:
+                self.loop.run_until_complete(self._session.close())
+            self._session = None
+        finally:
+            self._lock.release()
+
+    async def _poll(self, usernames, attempts: int, retry_delay: float) -> Dict[str, Model]:
+        if self.governor is not None:
+            semaphore = _GovernedSemaphore(self.governor)
+        else:
+            semaphore = asyncio.Semaphore(self.concurrency)
+        session = self._get_session()
+        model_instances_dict = {}
+
+        async def check(username: str) -> None:
+            model_instance = Model(username, autoupdate=False)
+            await self._update_model_status(session, semaphore, model_instance, attempts, retry_delay,
+                                            self.governor)
+            model_instances_dict[username] = model_instance
+
+        await asyncio.gather(*(check(username) for username in usernames))
+        return model_instances_dict
+
+    async def _fetch_images(self, model_instances, attempts: int, retry_delay: float) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        session = self._get_session()
+
+        async def fetch(model_instance: Model) -> None:
+            try:
+                await self._update_model_image(session, semaphore, model_instance, attempts, retry_delay)
+            except Exception:
+                model_instance.model_image = None
+
+        await asyncio.gather(*(fetch(model_instance) for model_instance in model_instances))
+
+    @staticmethod
+    async def _get(session: aiohttp.ClientSession, url: str) -> tuple:
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as http_response:
+                response = (http_response.status, await http_response.read())
+        except Exception:
+            ModelModule.record_http_request(url, time.perf_counter() - start)
+            raise
+        ModelModule.record_http_request(url, time.perf_counter() - start, response[0])
+        return response
+
+    @staticmethod
+    async def _update_model_status(session: aiohttp.ClientSession, semaphore, model_instance: Model, attempts: int,
+                                   retry_delay: float, governor: ConcurrencyGovernor = None) -> None:
+        """
+        Async equivalent of Model.update_model_status
+        """
+        response = None
+        for attempt in range(attempts):
+            # noinspection PyBroadException
+            try:
+                model_instance.last_update = datetime.datetime.now()
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await AsyncPoller._get(session,
+                                                      ModelModule.STATUS_URL.format(username=model_instance.username))
+            except Exception:
+                if governor is not None:
+                    governor.record(0, ok=False)
+                logging.info(model_instance.username + " has failed to connect on attempt " + str(attempt))
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(retry_delay)  # retry without holding a connection slot
+            else:
+                break
+
+        if response is None:
+            logging.info(model_instance.username + " has failed to connect after all attempts")
+            model_instance.status = "error"
+            model_instance.online = False
+        else:
+            model_instance.parse_model_status(*response)
+            if governor is not None:
+                governor.record(time.perf_counter() - start, ok=model_instance.status != "error",
+                                blocked=model_instance.blocked)
+
+    @staticmethod
+    async def _update_model_image(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                  model_instance: Model, attempts: int, retry_delay: float) -> None:
+        """
+        Async equivalent of Model.update_model_image
+
+        :raise ConnectionError if the image could not be downloaded
+        """
+        if model_instance.check_image_viewable():
+            for attempt in range(attempts):
+                try:
+                    async with semaphore:
+                        status_code, data = await AsyncPoller._get(
+                            session, ModelModule.IMAGE_URL.format(username=model_instance.username))
+                    # transcoding is cpu bound, keep it off the event loop
+                    data, model_instance.image_hash = await asyncio.get_event_loop().run_in_executor(
+                        None, ImagePipeline.process, data)
+                    model_instance.model_image = io.BytesIO(data)
+                except Exception:
+                    logging.info(model_instance.username + " has failed to obtain image on attempt " + str(attempt))
+                    if attempt + 1 < attempts:
+                        await asyncio.sleep(retry_delay)
+                else:
+                    return
+            logging.info(model_instance.username + " has failed to obtain image after all attempts")
+            raise ConnectionError
@@ -0,0 +1,158 @@
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from telegram.error import RetryAfter
+
+from modules import Utils
+from modules.NotificationDispatcher import NotificationDispatcher
+from modules.alchemy import Alchemy, BroadcastJob, PreferenceUser
+
+
+class Broadcaster:
+
+    def __init__(self, alchemy_instance: Alchemy, notification_dispatcher: NotificationDispatcher,
+                 send: Callable[[int, str], bool], report: Callable[[int, Optional[int], str], Optional[int]],
+                 chunk_size: int = 500, max_in_flight: int = 8, progress_interval: float = 5):
+        """
+        Sends a message to every user in the background, through the notification dispatcher so telegram's global
+        rate limit is shared with the notifications
+
+        Recipients are read in chat_id order, chunk_size at a time, and the job is checkpointed in the BROADCAST table
+        after every chunk, so a restarted bot resumes it sending again at most one chunk
+
+        :param alchemy_instance: The database with the recipients and the jobs
+        :param notification_dispatcher: The dispatcher which sends the messages
+        :param send: Called with (chatid, message) for every recipient, returns True if the message has been sent,
+                     it may raise RetryAfter
+        :param report: Called with (admin chatid, progress message id or None, text), sends or edits the progress
+                       message and returns its id
+        :param chunk_size: The recipients read and checkpointed at once
+        :param max_in_flight: The messages queued on the dispatcher at once, so notifications aren't stuck behind
+                              a whole chunk
+        :param progress_interval: Seconds between two updates of the progress message
+        """
+        self.alchemy_instance = alchemy_instance
+        self.notification_dispatcher = notification_dispatcher
+        self.send = send
+        self.report = report
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.progress_interval = progress_interval
+
+    def start(self, admin_chatid: int, message: str) -> int:
+        """
+        Starts broadcasting message to every user
+
+        :param admin_chatid: The chatid of the admin who receives the progress
+        :param message: The message to send
+        :return: The id of the job
+        """
+        session = self.alchemy_instance.session
+        total = session.query(PreferenceUser).count()
+        job = BroadcastJob(admin_chat_id=int(admin_chatid), message=message, total=total, sent=0, failed=0,
+                           finished=False)
+        session.add(job)
+        session.commit()
+        job_id = job.id
+        logging.info(f"{admin_chatid} started broadcast {job_id} to {total} users")
+        threading.Thread(target=self._run, args=(job_id,), daemon=True, name=f"broadcast-{job_id}").start()
+        return job_id
+
+    def resume(self) -> int:
+        """
+        Restarts the broadcasts interrupted by a shutdown
+
+        :return: The number of resumed broadcasts
+        """
+        session = self.alchemy_instance.session
+        job_ids = [job.id for job in session.query(BroadcastJob.id).filter_by(finished=False).all()]
+        session.commit()
+        for job_id in job_ids:
+            logging.info(f"Resuming broadcast {job_id}")
+            threading.Thread(target=self._run, args=(job_id,), daemon=True, name=f"broadcast-{job_id}").start()
+        return len(job_ids)
+
+    def _run(self, job_id: int) -> None:
+        try:
+            self._broadcast(job_id)
+        except Exception as e:  # resumed at the next start
+            Utils.handle_exception(e)
+
+    def _broadcast(self, job_id: int) -> None:
+        session = self.alchemy_instance.session
+        job: BroadcastJob = session.query(BroadcastJob).filter_by(id=job_id).one()
+        # the dispatcher threads only see copies, the job belongs to this thread's session
+        message, total, last_chatid = job.message, job.total, job.last_chat_id
+        checkpointed_sent, checkpointed_failed = job.sent, job.failed
+        window = threading.BoundedSemaphore(self.max_in_flight)
+        lock = threading.Lock()
+        counts = {"sent": 0, "failed": 0}  # in this run
+        started = time.monotonic()
+        last_report = 0.0
+
+        def send_one(chatid: int) -> None:
+            try:
+                sent = self.send(chatid, message)
+            except RetryAfter:
+                raise  # the dispatcher calls send_one again later
+            except Exception as e:
+                Utils.handle_exception(e)
+                sent = False
+            with lock:
+                counts["sent" if sent else "failed"] += 1
+            window.release()
+
+        def progress_text() -> str:
+            with lock:
+                sent, failed = checkpointed_sent + counts["sent"], checkpointed_failed + counts["failed"]
+                rate = (counts["sent"] + counts["failed"]) / max(time.monotonic() - started, 1e-9)
+            done = sent + failed
+            text = f"Broadcast {job_id}: {done}/{total} users, {sent} sent, {failed} failed"
+            if rate and done < total:
+                text += f"\nETA {datetime.timedelta(seconds=int((total - done) / rate))}"
+            return text
+
+        self._report(job, progress_text())
+        while True:
+            query = session.query(PreferenceUser.chat_id).order_by(PreferenceUser.chat_id)
+            if last_chatid is not None:
+                query = query.filter(PreferenceUser.chat_id > last_chatid)
+            chatids = [row.chat_id for row in query.limit(self.chunk_size).all()]
+            session.commit()
+            if not chatids:
+                break
+
+            for chatid in chatids:
+                window.acquire()
+                self.notification_dispatcher.put(chatid, send_one, chatid)
+                if time.monotonic() - last_report >= self.progress_interval:
+                    self._report(job, progress_text())
+                    last_report = time.monotonic()
+            for i in range(self.max_in_flight):  # wait for the whole chunk
+                window.acquire()
+            for i in range(self.max_in_flight):
+                window.release()
+
+            last_chatid = chatids[-1]
+            with lock:
+                job.sent, job.failed = checkpointed_sent + counts["sent"], checkpointed_failed + counts["failed"]
+            job.last_chat_id = last_chatid
+            session.commit()
+
+        job.finished = True
+        session.commit()
+        self._report(job, f"Broadcast {job_id} finished: {job.sent} users received the message, {job.failed} failed")
+        logging.info(f"Broadcast {job_id} finished, {job.sent} sent and {job.failed} failed")
+
+    def _report(self, job: BroadcastJob, text: str) -> None:
+        try:
+            message_id = self.report(job.admin_chat_id, job.progress_message_id, text)
+        except Exception as e:  # the broadcast goes on without progress
+            logging.warning(f"Could not report the progress of broadcast {job.id}: {e!r}")
+            return
+        if message_id is not None and message_id != job.progress_message_id:
+            job.progress_message_id = message_id
+            self.alchemy_instance.session.commit()
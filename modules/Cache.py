@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600, refresh_on_get: bool = True):
+        """
+        Thread safe LRU cache whose entries expire after ttl seconds
+
+        :param maxsize: The maximum number of entries, the least recently used one is evicted first
+        :param ttl: Seconds after which an entry expires, 0 = never
+        :param refresh_on_get: Reset the expiration of an entry whenever it's read, so only idle entries expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh_on_get = refresh_on_get
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expiration, value)
+
+    def _expiration(self) -> float:
+        if self.ttl:
+            return time.monotonic() + self.ttl
+        return float("inf")
+
+    def get(self, key, default=None):
+        """
+        :param key: The key to look up
+        :param default: The value returned when the key is missing or expired
+        :return: The cached value or default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            if self.refresh_on_get:
+                self._data[key] = (self._expiration(), entry[1])
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        """
+        :param key: The key to store
+        :param value: The value to store
+        """
+        with self._lock:
+            self._data[key] = (self._expiration(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        """
+        :param key: The key to remove, if present
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """
+        :return: A dict with the hits, misses and current size of the cache
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
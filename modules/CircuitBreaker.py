@@ -0,0 +1,52 @@
+import logging
+import threading
+from typing import Dict, List
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold: int = 5, park_time: float = 600):
+        """
+        Counts the consecutive failures of every model and parks the ones which keep failing
+
+        :param threshold: The number of consecutive failures after which a model is parked
+        :param park_time: The seconds a parked model isn't checked
+        """
+        self.threshold = threshold
+        self.park_time = park_time
+        self._lock = threading.Lock()
+        self._failures: Dict[str, int] = {}
+
+    def record_success(self, username: str) -> None:
+        """
+        :param username: The username whose check succeeded, its failures are reset
+        """
+        with self._lock:
+            self._failures.pop(username, None)
+
+    def record_failure(self, username: str) -> bool:
+        """
+        :param username: The username whose check failed
+        :return: True if the model has to be parked
+        """
+        with self._lock:
+            failures = self._failures.get(username, 0) + 1
+            self._failures[username] = failures
+        if failures >= self.threshold:
+            logging.warning(f"{username} failed {failures} times in a row, parked for {self.park_time} seconds")
+            return True
+        return False
+
+    def failure_counts(self) -> Dict[str, int]:
+        """
+        :return: username -> consecutive failures, for every model which is currently failing
+        """
+        with self._lock:
+            return dict(self._failures)
+
+    def parked(self) -> List[str]:
+        """
+        :return: The usernames which reached the failure threshold
+        """
+        with self._lock:
+            return [username for username, failures in self._failures.items() if failures >= self.threshold]
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+
+
+class ConcurrencyGovernor:
+
+    def __init__(self, min_limit: int = 1, max_limit: int = 100, initial_limit: int = None,
+                 latency_tolerance: float = 2.0, block_cooldown: float = 30):
+        """
+        Additive increase / multiplicative decrease limit of the status requests in flight
+
+        The limit grows by one every time a full window of requests succeeds with a healthy latency, it's halved
+        when chaturbate answers with a block (429, 403 or a cloudflare challenge) and reduced when the latency grows
+
+        :param min_limit: The lowest limit
+        :param max_limit: The highest limit
+        :param initial_limit: The starting limit, defaults to min(max_limit, 10)
+        :param latency_tolerance: How many times the baseline latency is considered congestion
+        :param block_cooldown: Seconds after a block during which the limit is not increased
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = initial_limit if initial_limit is not None else max(min_limit, min(max_limit, 10))
+        self.latency_tolerance = latency_tolerance
+        self.block_cooldown = block_cooldown
+        self.blocks = 0
+        self._latency = None  # exponentially weighted moving average
+        self._baseline = None
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """
+        Waits until a request can be started, for use from threads
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    def release(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _decrease(self, factor: float, reason: str) -> None:
+        now = time.monotonic()
+        latency = self._latency or 0
+        if now - self._last_decrease < latency:  # at most one decrease per round trip
+            return
+        self._last_decrease = now
+        new_limit = max(self.min_limit, int(self.limit * factor))
+        if new_limit != self.limit:
+            logging.warning(f"Lowering concurrency from {self.limit} to {new_limit} because of {reason}")
+        self.limit = new_limit
+        self._successes = 0
+
+    def record(self, latency: float, ok: bool, blocked: bool = False) -> None:
+        """
+        Adjusts the limit with the outcome of a request
+
+        :param latency: The seconds the request took
+        :param ok: True if the request got a valid answer
+        :param blocked: True if the request has been refused by rate limiting or a challenge page
+        """
+        with self._condition:
+            now = time.monotonic()
+            if blocked:
+                self.blocks += 1
+                self._blocked_until = now + self.block_cooldown
+                self._decrease(0.5, "a block")
+            elif ok:
+                self._latency = latency if self._latency is None else self._latency * 0.9 + latency * 0.1
+                if self._baseline is None or self._latency < self._baseline:
+                    self._baseline = self._latency
+                else:  # let the baseline follow slow changes of the network
+                    self._baseline = self._baseline * 0.999 + self._latency * 0.001
+
+                if self._latency > self._baseline * self.latency_tolerance:
+                    self._decrease(0.9, "rising latency")
+                elif now >= self._blocked_until:
+                    self._successes += 1
+                    if self._successes >= self.limit and self.limit < self.max_limit:
+                        self.limit += 1
+                        self._successes = 0
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """
+        :return: The current limit, requests in flight, latency and number of blocks
+        """
+        with self._condition:
+            return {"limit": self.limit, "in_flight": self._in_flight, "latency": self._latency,
+                    "baseline": self._baseline, "blocks": self.blocks}
@@ -0,0 +1,88 @@
+import io
+import logging
+import threading
+from typing import Optional, Tuple, Union
+
+from PIL import Image
+
+settings = {"max_size": 640, "quality": 75, "hash_threshold": 4}
+
+
+def configure(max_size: int, quality: int, hash_threshold: int) -> None:
+    """
+    Sets how stream images are transcoded and compared, call before the first image is processed
+
+    :param max_size: The longest side of a preview in pixels, 0 keeps the original size
+    :param quality: The jpeg quality of the previews, from 1 to 95
+    :param hash_threshold: The maximum number of different bits between the hashes of two similar images
+    """
+    settings.update(max_size=max_size, quality=quality, hash_threshold=hash_threshold)
+
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """
+    Difference hash: every bit tells if a pixel is brighter than its right neighbour in a tiny grayscale copy,
+    so recompression and small changes flip few bits while a different frame flips many
+
+    :param image: The image to hash
+    :param hash_size: The hash has hash_size * hash_size bits
+    :return: The hash as an integer
+    """
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            value = value << 1 | (left > right)
+    return value
+
+
+def process(data: bytes) -> Tuple[bytes, Optional[int]]:
+    """
+    Downscales and recompresses a stream image and computes its perceptual hash
+
+    :param data: The image as downloaded
+    :return: (jpeg preview, hash), the original bytes and None if the image could not be decoded
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        image_hash = dhash(image)
+        original_size = image.size
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if settings["max_size"]:
+            image.thumbnail((settings["max_size"], settings["max_size"]))
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=settings["quality"], optimize=True)
+    except Exception as e:
+        logging.warning(f"Could not transcode a stream image: {e!r}")
+        return data, None
+    if output.tell() >= len(data) and image.size == original_size:
+        return data, image_hash  # already smaller than we can make it
+    return output.getvalue(), image_hash
+
+
+def similar(hash_a: Optional[int], hash_b: Optional[int]) -> bool:
+    """
+    :param hash_a: The hash of an image, None if unknown
+    :param hash_b: The hash of another image, None if unknown
+    :return: True if the images are effectively the same frame
+    """
+    if hash_a is None or hash_b is None:
+        return False
+    return bin(hash_a ^ hash_b).count("1") <= settings["hash_threshold"]
+
+
+class SharedUpload:
+
+    def __init__(self, image: Union[bytes, str]):
+        """
+        A stream image sent to many chats by concurrent notifications, the first one to run uploads it while
+        holding lock and the others wait for the upload to send its telegram file_id
+
+        :param image: The image bytes or an already uploaded telegram file_id
+        """
+        self.image = image  # the bytes until an upload succeeds, then its file_id
+        self.lock = threading.Lock()
@@ -0,0 +1,88 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Dict, List, Tuple
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, limit: int = 20, interval: float = 60, sample_every: int = 100):
+        """
+        Limits how many records every call site writes, so a log line inside a loop can't flood the log
+
+        Each call site writes up to limit records every interval seconds, past that only one record in sample_every
+        is kept and it tells how many were dropped. Records with a traceback are always kept
+
+        :param limit: The records written by a call site every interval
+        :param interval: The length of a window in seconds
+        :param sample_every: Past the limit, one record in sample_every is kept
+        """
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.sample_every = max(1, sample_every)
+        self._lock = threading.Lock()
+        self._sites: Dict[Tuple[str, int], List] = {}  # (pathname, lineno) -> [window start, records, dropped]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.exc_info:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None:
+                site = self._sites[(record.pathname, record.lineno)] = [now, 0, 0]
+            elif now - site[0] >= self.interval:
+                site[0], site[1] = now, 0
+            site[1] += 1
+            if site[1] > self.limit and (site[1] - self.limit) % self.sample_every:
+                site[2] += 1
+                return False
+            dropped, site[2] = site[2], 0
+        if dropped:
+            record.msg = f"{record.getMessage()} [{dropped} similar messages dropped]"
+            record.args = None
+        return True
+
+
+def configure(filename: str, level: int = logging.INFO, use_queue: bool = True, max_bytes: int = 10485760,
+              backup_count: int = 5, rate_limit: int = 20, rate_interval: float = 60, sample_every: int = 100) -> None:
+    """
+    Sends the log records to a file, optionally through a queue so the threads logging never wait for the disk
+
+    The rate limit applies to the records logged through the root logger, which is what the bot uses,
+    the records of the libraries are written as they are
+
+    :param filename: The log file
+    :param level: The level of the root logger
+    :param use_queue: Write the records from a background thread
+    :param max_bytes: The size at which the file is rotated, 0 never rotates it
+    :param backup_count: The number of rotated files kept
+    :param rate_limit: The records written by a call site every rate_interval seconds, 0 = unlimited
+    :param rate_interval: The length of a rate limit window in seconds
+    :param sample_every: Past the rate limit, one record in sample_every is kept
+    """
+    if max_bytes:
+        file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                            encoding="utf-8")
+    else:
+        file_handler = logging.FileHandler(filename, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    if rate_limit:
+        root.addFilter(RateLimitFilter(rate_limit, rate_interval, sample_every))
+    if use_queue:
+        log_queue = queue.Queue(-1)
+        listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        listener.start()
+        atexit.register(listener.stop)  # writes what is still queued
+    else:
+        root.addHandler(file_handler)
@@ -0,0 +1,213 @@
+import bisect
+import functools
+import logging
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Dict, List, Tuple
+
+registry: List["Metric"] = []
+_registry_lock = threading.Lock()
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        """
+        A metric exported in the prometheus text format
+
+        :param name: The metric name, without the chaturbatebot_ prefix
+        :param documentation: The HELP line
+        :param labelnames: The names of the labels every sample has
+        """
+        self.name = "chaturbatebot_" + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, object] = {}
+        with _registry_lock:
+            registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(labelname, "")) for labelname in self.labelnames)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), function: Callable = None):
+        """
+        :param function: Called at every scrape, returns the value or a dict of label values tuple -> value
+        """
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                logging.error(f"Could not collect {self.name}: {e}")
+                return []
+            values = value if isinstance(value, dict) else {(): value}
+            with self._lock:
+                self._values = {tuple(str(label) for label in key): value for key, value in values.items()}
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+            if index < len(self.buckets):
+                counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = self._format_labels(key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = self._format_labels(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render() -> str:
+    """
+    :return: Every registered metric in the prometheus text exposition format
+    """
+    with _registry_lock:
+        metrics = list(registry)
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would flood the log
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True  # http.server.ThreadingHTTPServer only exists since python 3.7
+
+
+def start_http_server(port: int, address: str = "127.0.0.1") -> HTTPServer:
+    """
+    Serves /metrics from a daemon thread
+
+    :param port: The port to listen on
+    :param address: The address to listen on
+    :return: The running server
+    """
+    server = _ThreadingHTTPServer((address, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    logging.info(f"Serving metrics on http://{address}:{port}/metrics")
+    return server
+
+
+def instrument_engine(engine) -> None:
+    """
+    Counts the statements executed by a sqlalchemy engine
+
+    :param engine: The engine to instrument
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        db_statements.inc(statement=statement.lstrip().split(" ", 1)[0].upper())
+
+
+def timed_handler(name: str, callback: Callable) -> Callable:
+    """
+    Wraps a telegram handler callback to measure its latency
+
+    :param name: The handler name used as label
+    :param callback: The callback to wrap
+    :return: The wrapped callback
+    """
+
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return callback(update, context)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, handler=name)
+
+    return wrapper
+
+
+# metrics shared by many modules, the others are defined where they are used
+cycle_seconds = Histogram("poll_cycle_seconds", "Duration of a poll cycle")
+models_per_cycle = Gauge("poll_cycle_models", "Models checked by the last poll cycle")
+models_checked = Counter("models_checked_total", "Models checked by the poller, by status", ("status",))
+http_request_seconds = Histogram("http_request_seconds", "Latency of the requests to chaturbate", ("host",))
+http_responses = Counter("http_responses_total", "Responses received from chaturbate", ("host", "code"))
+notifications = Counter("notifications_total", "Telegram messages sent by the bot", ("type", "result"))
+db_statements = Counter("db_statements_total", "SQL statements executed", ("statement",))
+handler_seconds = Histogram("handler_seconds", "Latency of the telegram command handlers", ("handler",))
@@ -2,36 +2,140 @@ import datetime
 import io
 import json
 import logging
+import threading
 import time
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from modules import Exceptions
+from modules import ImagePipeline
+from modules import Metrics
 from modules import Utils
 
+STATUS_URL = "https://en.chaturbate.com/api/chatvideocontext/{username}"
+IMAGE_URL = "https://roomimg.stream.highwebmedia.com/ri/{username}.jpg"
+# bodies of the pages cloudflare sends instead of the api response when it's blocking us
+CHALLENGE_MARKERS = (b"cf-browser-verification", b"cf_chl_", b"Just a moment...", b"Attention Required! | Cloudflare")
+HEADERS = {
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.110 Safari/537.36', }
+
+http_settings = {"pool_size": 10, "keepalive": 30.0, "connect_timeout": 5.0, "read_timeout": 10.0}
+_http_session = None
+_http_session_lock = threading.Lock()
+_http_stats_lock = threading.Lock()
+_http_stats = {}  # host -> {"requests": int, "seconds": float}
+
+
+def configure_http(pool_size: int, keepalive: float, connect_timeout: float, read_timeout: float) -> None:
+    """
+    Sets the connection pool and timeouts, call before the first request
+
+    :param pool_size: The maximum number of connections kept open for every host
+    :param keepalive: Seconds an idle connection is kept open (used by the asyncio poller)
+    :param connect_timeout: Seconds to wait for a connection to be established
+    :param read_timeout: Seconds to wait for the server to send data
+    """
+    http_settings.update(pool_size=pool_size, keepalive=keepalive, connect_timeout=connect_timeout,
+                         read_timeout=read_timeout)
+
+
+def configure_endpoints(status_url: str = None, image_url: str = None) -> None:
+    """
+    Points the models to other servers, {username} is replaced with the model's username
+
+    :param status_url: The chatvideocontext url template, None keeps the current one
+    :param image_url: The stream image url template, None keeps the current one
+    """
+    global STATUS_URL, IMAGE_URL
+    if status_url is not None:
+        STATUS_URL = status_url
+    if image_url is not None:
+        IMAGE_URL = image_url
+
+
+def get_http_session() -> requests.Session:
+    """
+    The connection pool is shared by every thread, so connections survive the poller's short lived threads
+
+    :return: The shared keep-alive session, created on first use
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=http_settings["pool_size"])
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+            _http_session.headers.update(HEADERS)
+        return _http_session
+
+
+def record_http_request(url: str, seconds: float, status_code=None) -> None:
+    """
+    Adds a request to the per host latency statistics
+
+    :param url: The requested url
+    :param seconds: How long the request took
+    :param status_code: The http status code of the response, None if the request failed
+    """
+    host = urlsplit(url).hostname
+    with _http_stats_lock:
+        stats = _http_stats.setdefault(host, {"requests": 0, "seconds": 0.0})
+        stats["requests"] += 1
+        stats["seconds"] += seconds
+    Metrics.http_request_seconds.observe(seconds, host=host)
+    Metrics.http_responses.inc(host=host, code=status_code if status_code is not None else "error")
+
+
+def http_stats() -> dict:
+    """
+    :return: host -> {"requests", "seconds", "mean_latency"} since startup
+    """
+    with _http_stats_lock:
+        return {host: dict(stats, mean_latency=stats["seconds"] / stats["requests"])
+                for host, stats in _http_stats.items()}
+
 
 class Model:
+    autoupdate_interval = 10  # seconds after which autoupdate refreshes the status
 
-    def __init__(self, username, autoupdate=True):
+    def __init__(self, username, autoupdate=True, http_session: requests.Session = None):
         """
 
         :param username: The username to create a model instance of
-        :param autoupdate: Automatically update model variables when accessed if older than 10 seconds since last update
+        :param autoupdate: Automatically update model variables when accessed if older than autoupdate_interval seconds since last update
+        :param http_session: The session used for http requests, defaults to the shared keep-alive session
         """
+        self._http_session = http_session
+        self.blocked = False
         self._response = None
         self.__model_image = None
+        self.image_hash = None  # perceptual hash of model_image
         self.__online = None
         self.__status = None
         self.last_update = None
         self.username = username
         self.autoupdate = autoupdate
 
+    def _get(self, url: str) -> requests.Response:
+        session = self._http_session if self._http_session is not None else get_http_session()
+        start = time.perf_counter()
+        try:
+            response = session.get(url, timeout=(http_settings["connect_timeout"], http_settings["read_timeout"]))
+        except Exception:
+            record_http_request(url, time.perf_counter() - start)
+            raise
+        record_http_request(url, time.perf_counter() - start, response.status_code)
+        return response
+
     @property
     def status(self):
         if self.__status is None:
             self.update_model_status()
             return self.__status
-        elif (datetime.datetime.now() - self.last_update).total_seconds() > 10 and self.autoupdate:
+        elif (datetime.datetime.now() - self.last_update).total_seconds() > Model.autoupdate_interval and self.autoupdate:
             self.update_model_status()
         return self.__status
 
@@ -44,7 +148,7 @@ class Model:
         if self.__online is None:
             self.update_model_status()
             return self.__online
-        elif (datetime.datetime.now() - self.last_update).total_seconds() > 10 and self.autoupdate:
+        elif (datetime.datetime.now() - self.last_update).total_seconds() > Model.autoupdate_interval and self.autoupdate:
             self.update_model_status()
         return self.__online
 
@@ -67,35 +171,58 @@ class Model:
     def model_image(self, value):
         self.__model_image = value
 
-    def update_model_status(self):
+    def update_model_status(self, attempts: int = 5, retry_delay: float = 3):
         """
         Updates self.online and self.status
+
+        :param attempts: How many times the request is tried before setting the status to 'error'
+        :param retry_delay: Seconds to sleep between attempts
         """
-        for attempt in range(5):
+        self._response = None
+        for attempt in range(attempts):
             # noinspection PyBroadException
             try:
                 self.last_update = datetime.datetime.now()
-                target = f"https://en.chaturbate.com/api/chatvideocontext/{self.username}"
-                headers = {
-                    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.110 Safari/537.36', }
-                self._response = requests.get(target, headers=headers)
+                target = STATUS_URL.format(username=self.username)
+                self._response = self._get(target)
 
             except Exception:
                 self._response = None
                 logging.info(self.username + " has failed to connect on attempt " + str(attempt))
-                time.sleep(3)  # sleep and retry
+                if attempt + 1 < attempts:
+                    time.sleep(retry_delay)  # sleep and retry
             else:
                 break
 
         if self._response is None:
             logging.info(self.username + " has failed to connect after all attempts")
             self.status = "error"
+            self.online = False
+        else:
+            self.parse_model_status(self._response.status_code, self._response.content)
 
-        elif b"It's probably just a broken link, or perhaps a cancelled broadcaster." in self._response.content:  # check if models still exists
+    def parse_model_status(self, status_code: int, content: bytes) -> None:
+        """
+        Updates self.online and self.status from a chatvideocontext response
+
+        :param status_code: The http status code of the response
+        :param content: The raw body of the response
+        """
+        self._response = content
+        self.blocked = False
+        if self.last_update is None:
+            self.last_update = datetime.datetime.now()
+
+        if b"It's probably just a broken link, or perhaps a cancelled broadcaster." in content:  # check if models still exists
             self.status = "canceled"
 
-        elif self._response.status_code == 401:
-            self._response = json.loads(self._response.content)
+        elif status_code in (403, 429) or any(marker in content for marker in CHALLENGE_MARKERS):
+            logging.warning(f'{self.username} got blocked with a {status_code} response')
+            self.blocked = True
+            self.status = "error"
+
+        elif status_code == 401:
+            self._response = json.loads(content)
             if "Room is deleted" in str(self._response['detail']):
                 self.status = "deleted"
             elif "This room has been banned" in str(self._response['detail']):
@@ -107,13 +234,13 @@ class Model:
             else:
                 self.status = "error"
 
-        elif self._response.status_code == (200 and 401):
-            logging.error(f'{self.username} got a {self._response.status_code} error')
+        elif status_code == (200 and 401):
+            logging.error(f'{self.username} got a {status_code} error')
             self.status = "error"
 
         else:
             try:
-                self._response = json.loads(self._response.content)
+                self._response = json.loads(content)
             except Exception:
                 logging.critical("This response should have been json decodable")
                 self.status = "error"
@@ -125,11 +252,11 @@ class Model:
         else:
             self.online = True
 
-    def update_model_image(self):
+    def check_image_viewable(self) -> bool:
         """
-        Updates self.image
-
+        Checks if a stream image can be obtained for the current status
 
+        :return: True if the image can be downloaded
         :raise ModelOffline if self.status is 'offline'
         :raise ModelAway if self.status is 'away'
         :raise ModelPrivate if self.status is 'private' or 'hidden'
@@ -141,22 +268,7 @@ class Model:
         :raise ModelNotViewable if any other error happens
         """
         if self.online and self.status not in {"away", "private", "hidden", "password"}:
-            attempt_count = 0
-            for attempt in range(5):
-                try:
-                    data = requests.get(f'https://roomimg.stream.highwebmedia.com/ri/{self.username}.jpg').content
-                    bio_data = io.BytesIO(data)
-                    self.model_image = bio_data
-                except Exception as e:
-                    Utils.handle_exception(e)
-                    attempt_count += 1
-                    logging.info(self.username + " has failed to obtain image on attempt " + str(attempt))
-                    time.sleep(1)  # sleep and retry
-                else:
-                    break
-            if attempt_count == 5:
-                logging.info(self.username + " has failed to obtain image after all attempts")
-                raise ConnectionError
+            return True
         elif self.status == "offline":
             raise Exceptions.ModelOffline
         elif self.status == "away":
@@ -175,3 +287,41 @@ class Model:
             raise Exceptions.ModelCanceled
         else:
             raise Exceptions.ModelNotViewable
+
+    def update_model_image(self, attempts: int = 5, retry_delay: float = 1):
+        """
+        Updates self.image
+
+        :param attempts: How many times the download is tried before raising ConnectionError
+        :param retry_delay: Seconds to sleep between attempts
+
+
+        :raise ModelOffline if self.status is 'offline'
+        :raise ModelAway if self.status is 'away'
+        :raise ModelPrivate if self.status is 'private' or 'hidden'
+        :raise ModelPassword if self.status is 'password'
+        :raise ModelDeleted if self.status is 'deleted'
+        :raise ModelBanned if self.status is 'banned'
+        :raise ModelGeoblocked if self.status is 'geoblocked'
+        :raise ModelCanceled if self.status is 'canceled'
+        :raise ModelNotViewable if any other error happens
+        """
+        if self.check_image_viewable():
+            attempt_count = 0
+            for attempt in range(attempts):
+                try:
+                    data = self._get(IMAGE_URL.format(username=self.username)).content
+                    data, self.image_hash = ImagePipeline.process(data)
+                    bio_data = io.BytesIO(data)
+                    self.model_image = bio_data
+                except Exception as e:
+                    Utils.handle_exception(e)
+                    attempt_count += 1
+                    logging.info(self.username + " has failed to obtain image on attempt " + str(attempt))
+                    if attempt + 1 < attempts:
+                        time.sleep(retry_delay)  # sleep and retry
+                else:
+                    break
+            if attempt_count == attempts:
+                logging.info(self.username + " has failed to obtain image after all attempts")
+                raise ConnectionError
@@ -0,0 +1,144 @@
+import datetime
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Iterable
+
+from modules.Cache import TTLCache
+from modules.Model import Model
+
+
+class _Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ModelCache:
+
+    def __init__(self, ttl: float = 10, maxsize: int = 100000, workers: int = 10):
+        """
+        Process wide cache of model statuses and stream images, shared by the commands and the poller
+
+        Concurrent requests for the same username are coalesced into a single http request
+
+        :param ttl: Seconds after which a cached status or image is fetched again
+        :param maxsize: The maximum number of cached models
+        :param workers: The maximum number of models checked at the same time by get_many
+        """
+        self.ttl = ttl
+        # ("status", username) -> (status, online), ("image", username) -> (image, image_hash)
+        self._cache = TTLCache(maxsize, ttl, refresh_on_get=False)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="model-cache")
+
+    def _single_flight(self, key, fetch):
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+
+        if leader:
+            try:
+                call.result = fetch()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    @staticmethod
+    def _build(username: str, status: str, online: bool) -> Model:
+        model_instance = Model(username, autoupdate=False)
+        model_instance.status = status
+        model_instance.online = online
+        model_instance.last_update = datetime.datetime.now()
+        return model_instance
+
+    def put(self, model_instance: Model) -> None:
+        """
+        Seeds the cache with an already updated model
+
+        :param model_instance: The model, its image is cached too if it has one
+        """
+        self._cache.set(("status", model_instance.username), (model_instance.status, model_instance.online))
+        if model_instance.model_image is not None:
+            self._cache.set(("image", model_instance.username),
+                            (model_instance.model_image.getvalue(), model_instance.image_hash))
+        else:
+            self._cache.invalidate(("image", model_instance.username))
+
+    def _fetch_status(self, username: str) -> tuple:
+        # a single attempt, a command mustn't hold a worker while retrying, the poller's scheduler retries instead
+        model_instance = Model(username, autoupdate=False)
+        model_instance.update_model_status(attempts=1)
+        status = (model_instance.status, model_instance.online)
+        if model_instance.status != "error":  # the next command tries again
+            self._cache.set(("status", username), status)
+        return status
+
+    def get(self, username: str) -> Model:
+        """
+        :param username: The username of the model
+        :return: A model whose status is at most ttl seconds old
+        """
+        status = self._cache.get(("status", username))
+        if status is None:
+            status = self._single_flight(("status", username), lambda: self._fetch_status(username))
+        return self._build(username, *status)
+
+    def get_many(self, usernames: Iterable[str], timeout: float) -> Dict[str, Model]:
+        """
+        Gets many models at once, checking the ones which aren't cached concurrently
+
+        :param usernames: The usernames of the models
+        :param timeout: Seconds to wait for the models which aren't cached
+        :return: username -> model, the models which couldn't be checked before the timeout are missing
+        """
+        models = {}
+        futures = {}
+        for username in usernames:
+            status = self._cache.get(("status", username))
+            if status is not None:
+                models[username] = self._build(username, *status)
+            else:
+                futures[username] = self._executor.submit(self.get, username)
+        done = wait(futures.values(), timeout)[0]
+        for username, future in futures.items():
+            if future in done and future.exception() is None:
+                models[username] = future.result()
+            else:  # the queued ones would delay the other commands, the running ones end up in the cache
+                future.cancel()
+        return models
+
+    def _fetch_image(self, model_instance: Model) -> tuple:
+        model_instance.update_model_image()
+        image = (model_instance.model_image.getvalue(), model_instance.image_hash)
+        self._cache.set(("image", model_instance.username), image)
+        return image
+
+    def get_image(self, username: str) -> Model:
+        """
+        :param username: The username of the model
+        :return: A model whose status, stream image and image hash are at most ttl seconds old
+        :raise The same exceptions as Model.update_model_image
+        """
+        model_instance = self.get(username)
+        model_instance.check_image_viewable()
+        image = self._cache.get(("image", username))
+        if image is None:
+            image = self._single_flight(("image", username), lambda: self._fetch_image(model_instance))
+        model_instance.model_image = io.BytesIO(image[0])  # a new file object for every caller
+        model_instance.image_hash = image[1]
+        return model_instance
@@ -0,0 +1,165 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict
+
+from telegram.error import RetryAfter
+
+from modules import Utils
+from modules.Cache import TTLCache
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Classic token bucket, refilled with rate tokens per second
+
+        :param rate: The number of tokens added every second
+        :param capacity: The maximum burst, defaults to rate (at least 1)
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token, going into debt if none is available so that callers are served in order
+
+        :return: The seconds to wait before the token can be used, 0 if it can be used now
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate, self._paused_until - now)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stops handing out tokens for the given number of seconds
+
+        :param seconds: How long to pause
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class NotificationDispatcher:
+
+    def __init__(self, workers: int = 4, global_rate: float = 30, chat_rate: float = 1):
+        """
+        Sends telegram messages from a pool of worker threads, respecting telegram's flood limits
+
+        The messages of a chat are sent one at a time in the order they have been queued, a message waiting for its
+        rate limit or for an upload never lets a later one of the same chat go first
+
+        :param workers: The number of sending threads
+        :param global_rate: The maximum number of messages per second sent by the bot
+        :param chat_rate: The maximum number of messages per second sent to a single chat
+        """
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = TTLCache(maxsize=100000, ttl=60)
+        self._chat_buckets_lock = threading.Lock()
+        self._heap = []  # (when, sequence, chatid), every chat with queued messages is either here or being sent
+        self._queues: Dict[str, Deque[list]] = {}  # chatid -> [function, args, kwargs, chat token reserved]
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True, name=f"notification-worker-{i}").start()
+
+    def put(self, chatid: str, function, *args, **kwargs) -> None:
+        """
+        Queues function(*args, **kwargs), which sends a message to chatid
+
+        :param chatid: The chatid the message is sent to, used for the per chat rate limit
+        :param function: The function which sends the message, it may raise RetryAfter
+        """
+        chatid = str(chatid)
+        with self._condition:
+            queue = self._queues.get(chatid)
+            if queue is None:  # otherwise the chat is already scheduled
+                queue = self._queues[chatid] = deque()
+                self._schedule(time.monotonic(), chatid)
+            queue.append([function, args, kwargs, False])
+            self._queued += 1
+
+    def qsize(self) -> int:
+        """
+        :return: The number of messages waiting to be sent
+        """
+        with self._condition:
+            return self._queued
+
+    def _schedule(self, when: float, chatid: str) -> None:
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), chatid))
+            self._condition.notify()
+
+    def _next_chat(self) -> str:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                self._condition.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _done(self, chatid: str) -> None:
+        # the head message has been handled, the chat is scheduled again if more are queued
+        with self._condition:
+            queue = self._queues[chatid]
+            queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._schedule(time.monotonic(), chatid)
+            else:
+                del self._queues[chatid]
+
+    def _chat_bucket(self, chatid: str) -> TokenBucket:
+        with self._chat_buckets_lock:
+            bucket = self._chat_buckets.get(chatid)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate)
+                self._chat_buckets.set(chatid, bucket)
+            return bucket
+
+    def _worker(self) -> None:
+        while True:
+            chatid = self._next_chat()
+            with self._condition:
+                job = self._queues[chatid][0]
+            function, args, kwargs, chat_token_reserved = job
+
+            if not chat_token_reserved:
+                job[3] = True
+                delay = self._chat_bucket(chatid).reserve()
+                if delay > 0:  # let the other workers send to other chats meanwhile
+                    self._schedule(time.monotonic() + delay, chatid)
+                    continue
+
+            delay = self.global_bucket.reserve()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                function(*args, **kwargs)
+            except RetryAfter as e:
+                logging.warning(f"Telegram asked to retry after {e.retry_after} seconds, pausing notifications")
+                self.global_bucket.pause(e.retry_after)
+                self._schedule(time.monotonic() + e.retry_after, chatid)  # the message stays first
+                continue
+            except Exception as e:
+                Utils.handle_exception(e)
+            self._done(chatid)
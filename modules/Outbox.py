@@ -0,0 +1,137 @@
+import logging
+import select
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from modules import Utils
+from modules.alchemy import Alchemy, OutboxEvent
+
+CHANNEL = "chaturbatebot_outbox"
+
+
+Event = Tuple[str, str, str, Optional[List[int]]]
+
+
+def publish(session, events: List[Event]) -> None:
+    """
+    Adds status change events to the outbox in the current transaction, listeners are notified when it commits
+
+    :param session: The session whose transaction writes the status changes
+    :param events: (kind, username, status, chatids) tuples, chatids is None for the events of every follower
+    """
+    rows = []
+    for kind, username, status, chatids in events:
+        if chatids is None:
+            rows.append(dict(kind=kind, username=username, chat_id=None, status=status))
+        else:
+            rows.extend(dict(kind=kind, username=username, chat_id=chatid, status=status) for chatid in chatids)
+    if not rows:
+        return
+    session.execute(OutboxEvent.__table__.insert(), rows)
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text(f"NOTIFY {CHANNEL}"))
+
+
+def _group(rows: List[OutboxEvent]) -> List[Event]:
+    # the rows of the same event are adjacent, a chatid per row
+    events = []
+    for row in rows:
+        if row.chat_id is None:
+            events.append((row.kind, row.username, row.status, None))
+        elif events and events[-1][:3] == (row.kind, row.username, row.status) and events[-1][3] is not None:
+            events[-1][3].append(row.chat_id)
+        else:
+            events.append((row.kind, row.username, row.status, [row.chat_id]))
+    return events
+
+
+class OutboxConsumer:
+
+    def __init__(self, alchemy_instance: Alchemy, handle_events: Callable[[List[Event]], None],
+                 poll_interval: float = 5, batch_size: int = 1000):
+        """
+        Hands the events published by the pollers to handle_events, in order
+
+        On postgres the consumer waits for LISTEN notifications, on other databases it reads the outbox every
+        poll_interval seconds. Events are deleted only after handle_events returns, on postgres they are locked
+        until then so many consumers can share the outbox
+
+        :param alchemy_instance: The database with the outbox
+        :param handle_events: Called with lists of (kind, username, status, chatids) tuples
+        :param poll_interval: The longest time between two reads of the outbox
+        :param batch_size: The maximum number of events handled at once
+        """
+        self.alchemy_instance = alchemy_instance
+        self.handle_events = handle_events
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, daemon=True, name="outbox-consumer").start()
+
+    def consume(self) -> int:
+        """
+        Handles every event in the outbox
+
+        :return: The number of handled events
+        """
+        session = self.alchemy_instance.session
+        handled = 0
+        try:
+            while True:
+                query = session.query(OutboxEvent).order_by(OutboxEvent.id).limit(self.batch_size)
+                if session.get_bind().dialect.name == "postgresql":  # the other consumers skip these events
+                    query = query.with_for_update(skip_locked=True)
+                rows = query.all()
+                if not rows:
+                    session.commit()
+                    return handled
+                self.handle_events(_group(rows))
+                # ids may commit out of order, so only the handled ones are deleted
+                session.query(OutboxEvent).filter(OutboxEvent.id.in_([row.id for row in rows])).delete(
+                    synchronize_session=False)
+                session.commit()
+                handled += len(rows)
+        except Exception:
+            session.rollback()
+            raise
+
+    def _listen(self):
+        if self.alchemy_instance.engine.dialect.name != "postgresql":
+            return None
+        connection = self.alchemy_instance.engine.raw_connection()
+        dbapi_connection = getattr(connection, "dbapi_connection", None) or connection.connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        logging.info(f"Listening for status changes on {CHANNEL}")
+        return connection
+
+    def _wait(self, connection) -> None:
+        if connection is None:
+            time.sleep(self.poll_interval)
+            return
+        dbapi_connection = getattr(connection, "dbapi_connection", None) or connection.connection
+        if select.select([dbapi_connection], [], [], self.poll_interval)[0]:
+            dbapi_connection.poll()
+            dbapi_connection.notifies.clear()  # one read of the outbox serves every notification
+
+    def _run(self) -> None:
+        connection = None
+        while True:
+            try:
+                if connection is None:
+                    connection = self._listen()
+                handled = self.consume()
+                if handled:
+                    logging.info(f"{handled} status changes have been read from the outbox")
+                self._wait(connection)
+            except Exception as e:
+                Utils.handle_exception(e)
+                if connection is not None:
+                    connection.invalidate()
+                    connection = None
+                time.sleep(self.poll_interval)
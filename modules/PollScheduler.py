@@ -0,0 +1,136 @@
+import random
+import threading
+import time
+from typing import Dict, Iterable, List
+
+
+class ModelSchedule:
+
+    def __init__(self, now: float):
+        """
+        Polling state and status history of a single model
+
+        :param now: The time the model has been seen for the first time
+        """
+        self.next_check = now
+        self.first_seen = now
+        self.last_online = None
+        self.errors = 0
+        self.hourly_checks = [0] * 24
+        self.hourly_online = [0] * 24
+
+    def online_probability(self, hour: int) -> float:
+        """
+        :param hour: The hour of the day
+        :return: The smoothed fraction of checks made at this hour which found the model online
+        """
+        return (self.hourly_online[hour] + 1) / (self.hourly_checks[hour] + 2)
+
+
+class PollScheduler:
+
+    def __init__(self, min_interval: float = 15, max_interval: float = 300, retry_interval: float = 2):
+        """
+        Decides when every model is checked again, based on its status history
+
+        Online models are checked every min_interval seconds, offline ones less often the longer they have been
+        offline, unless they usually stream at this time of the day. No model waits more than max_interval seconds
+
+        :param min_interval: The shortest time between two checks of the same model
+        :param max_interval: The longest time between two checks of the same model, the upper bound of the delay of a notification
+        :param retry_interval: The delay before retrying a failed check, doubled after every consecutive failure
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._schedules: Dict[str, ModelSchedule] = {}
+
+    def due(self, usernames: Iterable[str], now: float = None) -> List[str]:
+        """
+        Returns the usernames which have to be checked now, models never seen before are always due
+
+        :param usernames: Every followed username, the others are forgotten
+        :param now: The current time, defaults to time.time()
+        :return: The usernames to check
+        """
+        now = time.time() if now is None else now
+        usernames = set(usernames)
+        with self._lock:
+            for username in set(self._schedules) - usernames:
+                del self._schedules[username]
+            return [username for username in usernames
+                    if username not in self._schedules or self._schedules[username].next_check <= now]
+
+    def seconds_until_next(self, now: float = None) -> float:
+        """
+        :param now: The current time, defaults to time.time()
+        :return: The seconds until the next model is due, 0 if one is already due, min_interval if none is scheduled
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self._schedules:  # nothing to poll, the models followed meanwhile are due immediately anyway
+                return self.min_interval
+            return max(0.0, min(schedule.next_check for schedule in self._schedules.values()) - now)
+
+    def record(self, username: str, status: str, online: bool, now: float = None) -> float:
+        """
+        Stores the result of a check and schedules the next one
+
+        :param username: The checked username
+        :param status: The status found by the check
+        :param online: The online value found by the check
+        :param now: The time of the check, defaults to time.time()
+        :return: The seconds until the next check
+        """
+        now = time.time() if now is None else now
+        hour = time.localtime(now).tm_hour
+        with self._lock:
+            schedule = self._schedules.get(username)
+            if schedule is None:
+                schedule = self._schedules[username] = ModelSchedule(now)
+
+            if status == "error":
+                # exponential backoff with jitter, so failed models don't all retry in the same cycle
+                schedule.errors += 1
+                interval = self.retry_interval * 2 ** min(schedule.errors - 1, 16) * random.uniform(0.5, 1.5)
+            else:
+                schedule.errors = 0
+                schedule.hourly_checks[hour] += 1
+                if online:
+                    schedule.hourly_online[hour] += 1
+                    schedule.last_online = now
+                interval = max(self._interval(schedule, status, online, now, hour), self.min_interval)
+
+            interval = min(interval, self.max_interval)
+            schedule.next_check = now + interval
+            return interval
+
+    def postpone(self, username: str, seconds: float, now: float = None) -> None:
+        """
+        Delays the next check of a model, even beyond max_interval
+
+        :param username: The username to delay
+        :param seconds: The seconds from now until the next check
+        :param now: The current time, defaults to time.time()
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            schedule = self._schedules.get(username)
+            if schedule is None:
+                schedule = self._schedules[username] = ModelSchedule(now)
+            schedule.next_check = now + seconds
+
+    def _interval(self, schedule: ModelSchedule, status: str, online: bool, now: float, hour: int) -> float:
+        if online:
+            return self.min_interval
+        if status in {"deleted", "banned", "canceled", "geoblocked"}:
+            return self.max_interval
+
+        # one more min_interval for every hour since the model was last seen online
+        offline_since = schedule.last_online if schedule.last_online is not None else schedule.first_seen
+        interval = self.min_interval * (1 + (now - offline_since) / 3600)
+
+        # models which usually stream at this hour are checked as if they had just gone offline
+        probability = max(schedule.online_probability(hour), schedule.online_probability((hour + 1) % 24))
+        return interval * (1 - probability) + self.min_interval * probability
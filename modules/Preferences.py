@@ -1,7 +1,12 @@
 import logging
 
 from modules import Utils
+from modules.Cache import TTLCache
 from modules.alchemy import PreferenceUser
+from modules.argparse_code import args
+
+# chatid -> (link_preview, notifications_sound), written through on every update
+preferences_cache = TTLCache(args["cache_size"], args["cache_ttl"])
 
 
 def user_has_preferences(chatid: str) -> bool:
@@ -12,7 +17,9 @@ def user_has_preferences(chatid: str) -> bool:
     :param chatid: The chatid of the user who will be tested
     :return: True if it exists, False if it doesn't exist
     """
-    results = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).first()
+    if preferences_cache.get(str(chatid)) is not None:
+        return True
+    results = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=int(chatid)).first()
     if results is None:
         return False
     else:
@@ -25,8 +32,9 @@ def add_user_to_preferences(chatid: str) -> None:
 
     :param chatid: The chatid of the user who will be tested
     """
-    Utils.alchemy_instance.session.add(PreferenceUser(chat_id=str(chatid)))
+    Utils.alchemy_instance.session.add(PreferenceUser(chat_id=int(chatid), link_preview=1, notifications_sound=True))
     Utils.alchemy_instance.session.commit()
+    preferences_cache.set(str(chatid), (1, True))
     logging.info(f'{chatid} has been added to preferences')
 
 
@@ -36,12 +44,34 @@ def remove_user_from_preferences(chatid: str) -> None:
 
     :param chatid: The chatid of the user who will be removed
     """
-    user: PreferenceUser = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).first()
+    user: PreferenceUser = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=int(chatid)).first()
     Utils.alchemy_instance.session.delete(user)
     Utils.alchemy_instance.session.commit()
+    preferences_cache.invalidate(str(chatid))
     logging.info(f'{chatid} has been removed from preferences')
 
 
+def get_user_preferences(chatid: str) -> tuple:
+    """
+    Retrieve every preference of the user, creating them if missing
+
+    :param chatid: The chatid of the user who will be tested
+    :return: A (link_preview, notifications_sound) tuple
+    """
+    preferences = preferences_cache.get(str(chatid))
+    if preferences is not None:
+        return preferences
+
+    user: PreferenceUser = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=int(chatid)).first()
+    if user is None:
+        add_user_to_preferences(chatid)
+        return preferences_cache.get(str(chatid), (1, True))
+
+    preferences = (user.link_preview, user.notifications_sound)
+    preferences_cache.set(str(chatid), preferences)
+    return preferences
+
+
 def update_link_preview_preference(chatid: str, value: bool) -> None:
     """
     Update the link_preview preference of the user
@@ -52,9 +82,10 @@ def update_link_preview_preference(chatid: str, value: bool) -> None:
     if not user_has_preferences(chatid):
         add_user_to_preferences(chatid)
 
-    user: PreferenceUser = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).first()
+    user: PreferenceUser = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=int(chatid)).first()
     user.link_preview = value
     Utils.alchemy_instance.session.commit()
+    preferences_cache.set(str(chatid), (user.link_preview, user.notifications_sound))
 
 
 def get_user_link_preview_preference(chatid: str) -> bool:
@@ -64,10 +95,7 @@ def get_user_link_preview_preference(chatid: str) -> bool:
     :param chatid: The chatid of the user who will be tested
     :return: The boolean value of the preference
     """
-    if not user_has_preferences(chatid):
-        add_user_to_preferences(chatid)
-
-    return Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).first().link_preview
+    return get_user_preferences(chatid)[0]
 
 
 def update_notifications_sound_preference(chatid: str, value: bool) -> None:
@@ -80,9 +108,10 @@ def update_notifications_sound_preference(chatid: str, value: bool) -> None:
     if not user_has_preferences(chatid):
         add_user_to_preferences(chatid)
 
-    user: PreferenceUser = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).first()
+    user: PreferenceUser = Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=int(chatid)).first()
     user.notifications_sound = value
     Utils.alchemy_instance.session.commit()
+    preferences_cache.set(str(chatid), (user.link_preview, user.notifications_sound))
 
 
 def get_user_notifications_sound_preference(chatid: str) -> bool:
@@ -92,7 +121,4 @@ def get_user_notifications_sound_preference(chatid: str) -> bool:
     :param chatid: The chatid of the user who will be tested
     :return: The boolean value of the preference
     """
-    if not user_has_preferences(chatid):
-        add_user_to_preferences(chatid)
-
-    return Utils.alchemy_instance.session.query(PreferenceUser).filter_by(chat_id=str(chatid)).first().notifications_sound
+    return get_user_preferences(chatid)[1]
@@ -0,0 +1,204 @@
+import contextlib
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class ProfileSession:
+
+    def __init__(self, kind: str, count: int, chatid: Optional[int] = None, handler: Optional[str] = None):
+        """
+        :param kind: "cycles" or "handlers"
+        :param count: The number of cycles or handler calls still to profile
+        :param chatid: The admin who started it, None when started from the command line
+        :param handler: Only profile the calls of this handler, None profiles every handler
+        """
+        self.kind = kind
+        self.remaining = count
+        self.chatid = chatid
+        self.handler = handler
+        self.stats: Optional[pstats.Stats] = None
+        self.timings: List[Dict[str, float]] = []  # stage -> seconds, for every profiled call
+
+
+class Profiler:
+
+    def __init__(self, folder: str, report: Callable[[Optional[int], str], None]):
+        """
+        Profiles the next poll cycles or command handler calls on demand with cProfile
+
+        The profile is written to folder in the pstats format (python -m pstats, snakeviz...) together with a text
+        file breaking the time down by stage. A single call is profiled at a time, the ones running meanwhile
+        aren't profiled nor counted, cProfile can't profile two threads at once since python 3.12
+
+        :param folder: The folder the profiles are written to
+        :param report: Called with (admin chatid or None, summary) when a profile has been written
+        """
+        self.folder = folder
+        self.report = report
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+        self._sessions: Dict[str, ProfileSession] = {}
+        self._local = threading.local()
+
+    def start(self, kind: str, count: int, chatid: Optional[int] = None, handler: Optional[str] = None) -> None:
+        """
+        Profiles the next count poll cycles or handler calls, replacing the running session of the same kind
+
+        :param kind: "cycles" or "handlers"
+        :param count: The number of cycles or handler calls to profile
+        :param chatid: The admin who receives the summary
+        :param handler: Only profile the calls of this handler
+        """
+        with self._lock:
+            self._sessions[kind] = ProfileSession(kind, count, chatid, handler)
+        logging.info(f"Profiling the next {count} {kind}{f' of {handler}' if handler else ''}")
+
+    def running(self) -> List[ProfileSession]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def cycle(self):
+        """
+        Profiles the poll cycle run inside the returned context manager, if a session asks for it
+        """
+        return self._profiled("cycles", "cycle")
+
+    def skip_cycle(self) -> None:
+        """
+        Doesn't count the current cycle, it had nothing to poll
+        """
+        self._local.skip = True
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Times a stage of the cycle or handler call being profiled by this thread, does nothing otherwise
+
+        :param name: The stage name
+        """
+        timings = getattr(self._local, "timings", None)
+        if timings is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+    def profiled_handler(self, name: str, callback: Callable) -> Callable:
+        """
+        Wraps a telegram handler callback so its calls can be profiled
+
+        :param name: The handler name, used to profile a single handler
+        :param callback: The callback to wrap
+        :return: The wrapped callback
+        """
+
+        @functools.wraps(callback)
+        def wrapper(update, context):
+            with self._profiled("handlers", name):
+                return callback(update, context)
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def _profiled(self, kind: str, name: str):
+        with self._lock:
+            session = self._sessions.get(kind)
+            if session is not None and session.handler not in (None, name):
+                session = None
+            if session is not None and not self._profiling.acquire(blocking=False):
+                session = None
+        if session is None:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        timings = self._local.timings = {}
+        self._local.skip = False
+        start = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError:  # another tool is using the profiler
+            self._local.timings = None
+            self._profiling.release()
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            timings[name if kind == "handlers" else "total"] = time.perf_counter() - start
+            self._local.timings = None
+            self._profiling.release()
+            if not self._local.skip:
+                self._record(session, profile, timings)
+
+    def _record(self, session: ProfileSession, profile: cProfile.Profile, timings: Dict[str, float]) -> None:
+        with self._lock:
+            if self._sessions.get(session.kind) is not session:  # replaced meanwhile
+                return
+            if session.stats is None:
+                session.stats = pstats.Stats(profile)
+            else:
+                session.stats.add(profile)
+            session.timings.append(timings)
+            session.remaining -= 1
+            if session.remaining > 0:
+                return
+            del self._sessions[session.kind]
+
+        try:
+            summary = self._write(session)
+        except Exception as e:
+            logging.error(f"Could not write the profile of {len(session.timings)} {session.kind}: {e!r}")
+            return
+        logging.info(summary)
+        self.report(session.chatid, summary)
+
+    def _write(self, session: ProfileSession) -> str:
+        path = os.path.join(self.folder, f"profile_{session.kind}_{time.strftime('%Y%m%d_%H%M%S')}")
+        session.stats.dump_stats(path + ".prof")
+        summary = f"{len(session.timings)} {session.kind} profiled, written to {path}.prof\n" + \
+                  breakdown(session.timings)
+        top_functions = io.StringIO()
+        session.stats.stream = top_functions
+        session.stats.sort_stats("cumulative").print_stats(40)
+        with open(path + ".txt", "w") as summary_file:
+            summary_file.write(summary + "\n\n" + top_functions.getvalue())
+        return summary
+
+
+def breakdown(timings: List[Dict[str, float]]) -> str:
+    """
+    Sums the time spent in every stage
+
+    :param timings: stage -> seconds of every profiled call, a "total" stage is the whole call
+    :return: One line per stage with its total, mean and max time, and its share of the total
+    """
+    stages: Dict[str, List[float]] = {}
+    for call_timings in timings:
+        for stage, seconds in call_timings.items():
+            stages.setdefault(stage, []).append(seconds)
+    if "total" in stages:  # the time outside of the timed stages
+        stages["other"] = [call_timings.get("total", 0.0) - sum(seconds for stage, seconds in call_timings.items()
+                                                                  if stage != "total")
+                           for call_timings in timings]
+    total = sum(stages.get("total", [])) or sum(sum(seconds) for seconds in stages.values())
+
+    lines = []
+    for stage, seconds in sorted(stages.items(), key=lambda item: sum(item[1]), reverse=True):
+        line = f"{stage}: {sum(seconds):.3f}s, mean {sum(seconds) / len(seconds) * 1000:.1f}ms, " \
+               f"max {max(seconds) * 1000:.1f}ms"
+        if stage != "total" and total:
+            line += f", {sum(seconds) / total:.0%}"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,162 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, List, Tuple
+
+from modules import Utils
+from modules.alchemy import Alchemy, PollerWorker
+
+
+def _hash(value: str) -> int:
+    # hash() is randomized for every process, every worker must place a username at the same point of the ring
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+
+    def __init__(self, workers: List[str], virtual_nodes: int = 64):
+        """
+        Consistent hashing ring, a worker joining or leaving only moves the usernames of its own arcs
+
+        :param workers: The ids of the workers on the ring
+        :param virtual_nodes: The points every worker has on the ring, more points give more even shards
+        """
+        self.workers = sorted(workers)
+        self._points: List[Tuple[int, str]] = sorted(
+            (_hash(f"{worker}#{i}"), worker) for worker in self.workers for i in range(virtual_nodes))
+        self._hashes = [point for point, worker in self._points]
+
+    def owner(self, username: str) -> str:
+        """
+        :param username: The username to place on the ring
+        :return: The id of the worker owning the username, None if the ring is empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, _hash(username)) % len(self._points)
+        return self._points[index][1]
+
+
+class ShardCoordinator:
+
+    def __init__(self, alchemy_instance: Alchemy, lease_time: float = 30, heartbeat_interval: float = 5,
+                 virtual_nodes: int = 64):
+        """
+        Splits the followed models among the poller workers registered in the POLLER_WORKER table
+
+        Every worker increases its beat every heartbeat_interval seconds, a worker whose beat doesn't change for
+        lease_time seconds is considered dead and deleted, so its shard moves to the others.
+        After the membership changes a worker only polls the usernames it owned both before and after the change
+        until everyone had the time to notice it, so a model is never polled by two workers
+
+        :param alchemy_instance: The database used for the coordination
+        :param lease_time: Seconds without heartbeats after which a worker is considered dead
+        :param heartbeat_interval: Seconds between two heartbeats, must be well below lease_time
+        :param virtual_nodes: The points every worker has on the hash ring
+        """
+        self.alchemy_instance = alchemy_instance
+        self.lease_time = lease_time
+        self.heartbeat_interval = heartbeat_interval
+        self.virtual_nodes = virtual_nodes
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._ring = HashRing([], virtual_nodes)
+        self._previous_ring = self._ring
+        self._settled_at = 0.0  # monotonic time after which _previous_ring is ignored
+        self._beat = 0
+        self._seen: Dict[str, Tuple[int, float]] = {}  # worker_id -> (beat, monotonic time the beat changed)
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """
+        Registers the worker and keeps sending heartbeats from a daemon thread
+        """
+        self.heartbeat()
+        threading.Thread(target=self._heartbeat_loop, daemon=True, name="shard-heartbeat").start()
+
+    def stop(self) -> None:
+        """
+        Unregisters the worker, so the others take over its shard without waiting for the lease to expire
+        """
+        self._stopped.set()
+        session = self.alchemy_instance.session
+        try:
+            session.query(PollerWorker).filter_by(worker_id=self.worker_id).delete(synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            Utils.handle_exception(e)
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                Utils.handle_exception(e)
+
+    def heartbeat(self) -> None:
+        """
+        Renews this worker's lease, expires the dead workers and rebuilds the ring if the membership changed
+        """
+        session = self.alchemy_instance.session
+        now = time.monotonic()
+        try:
+            self._beat += 1
+            updated = session.query(PollerWorker).filter_by(worker_id=self.worker_id).update(
+                {PollerWorker.beat: self._beat}, synchronize_session=False)
+            if not updated:  # first heartbeat, or a worker wrongly expired us after a long pause
+                session.add(PollerWorker(worker_id=self.worker_id, beat=self._beat))
+
+            workers = []
+            for worker_id, beat in session.query(PollerWorker.worker_id, PollerWorker.beat).all():
+                last_beat, changed_at = self._seen.get(worker_id, (None, now))
+                if beat != last_beat:
+                    changed_at = now
+                self._seen[worker_id] = (beat, changed_at)
+                if worker_id != self.worker_id and now - changed_at > self.lease_time:
+                    logging.warning(f"Poller worker {worker_id} missed its heartbeats, taking over its shard")
+                    session.query(PollerWorker).filter_by(worker_id=worker_id, beat=beat).delete(
+                        synchronize_session=False)
+                    del self._seen[worker_id]
+                else:
+                    workers.append(worker_id)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        for worker_id in set(self._seen) - set(workers):
+            del self._seen[worker_id]
+        with self._lock:
+            if sorted(workers) != self._ring.workers:
+                logging.info(f"Poller workers changed to {sorted(workers)}")
+                if self._ring.workers:
+                    self._previous_ring = self._ring
+                else:  # just joined, wait for the others to make room unless we are alone
+                    others = [worker_id for worker_id in workers if worker_id != self.worker_id]
+                    self._previous_ring = HashRing(others or workers, self.virtual_nodes)
+                self._ring = HashRing(workers, self.virtual_nodes)
+                # everyone notices the change within one heartbeat, plus the time of a poll cycle already started
+                self._settled_at = now + 2 * self.heartbeat_interval
+
+    def owns(self, username: str) -> bool:
+        """
+        :param username: The username of a followed model
+        :return: True if this worker has to poll the model
+        """
+        with self._lock:
+            if self._ring.owner(username) != self.worker_id:
+                return False
+            return time.monotonic() >= self._settled_at or self._previous_ring.owner(username) == self.worker_id
+
+    def workers(self) -> List[str]:
+        """
+        :return: The ids of the workers currently sharing the models
+        """
+        with self._lock:
+            return list(self._ring.workers)
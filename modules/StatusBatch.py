@@ -0,0 +1,129 @@
+from typing import Dict, List, Optional, Tuple
+
+from modules import Outbox
+from modules.SubscriptionIndex import SubscriptionIndex, mark_changed
+from modules.alchemy import Alchemy, ChaturbateModel, Subscription
+
+
+class StatusBatch:
+
+    def __init__(self):
+        """
+        Collects the online/offline transitions and removals of the models polled in a cycle
+        so they can be written at once
+        """
+        self.went_online: Dict[str, str] = {}  # username -> status
+        self.went_offline: Dict[str, str] = {}
+        self.removed: Dict[str, str] = {}
+        self.removed_chats: Dict[str, List[int]] = {}  # username -> chatids, read when the removal is written
+        # username -> online stored in the database, None if the model is gone, for the changes already written
+        self.stale: Dict[str, Optional[bool]] = {}
+
+    def __len__(self) -> int:
+        return len(self.went_online) + len(self.went_offline) + len(self.removed)
+
+    def set_online(self, username: str, online: bool, status: str) -> None:
+        """
+        :param username: The model's username
+        :param online: The new online status
+        :param status: The status found by the poller
+        """
+        if online:
+            self.went_online[username] = status
+        else:
+            self.went_offline[username] = status
+
+    def remove(self, username: str, status: str) -> None:
+        """
+        :param username: The model whose subscriptions will be deleted
+        :param status: The status found by the poller, the reason of the removal
+        """
+        self.removed[username] = status
+
+    def flush(self, alchemy_instance: Alchemy, publish: bool = False) -> int:
+        """
+        Writes the whole batch in a single transaction, using one statement per kind of change and status
+
+        Changes which another poller already wrote are dropped from the batch, notify only the events() left
+
+        :param alchemy_instance: The database to write to
+        :param publish: Publish the events to the outbox atomically
+        :return: The number of rows written
+        """
+        session = alchemy_instance.session
+        models = ChaturbateModel.__table__
+        subscriptions = Subscription.__table__
+        rows = 0
+        try:
+            model_ids = self._discard_stale(session, models)
+            for online, changes in ((True, self.went_online), (False, self.went_offline)):
+                by_status = {}
+                for username, status in changes.items():
+                    by_status.setdefault(status, []).append(username)
+                for status, usernames in by_status.items():
+                    rows += session.execute(models.update().where(models.c.username.in_(usernames)).values(
+                        online=online, status=status)).rowcount
+            if self.removed:
+                ids = [model_ids[username] for username in self.removed]
+                id_to_username = {model_ids[username]: username for username in self.removed}
+                self.removed_chats = {}
+                for row in session.execute(subscriptions.select().where(subscriptions.c.model_id.in_(ids))):
+                    self.removed_chats.setdefault(id_to_username[row.model_id], []).append(row.chat_id)
+                rows += session.execute(subscriptions.delete().where(subscriptions.c.model_id.in_(ids))).rowcount
+                rows += session.execute(models.delete().where(models.c.id.in_(ids))).rowcount
+                mark_changed(session)
+            if publish:
+                Outbox.publish(session, self.events())
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return rows
+
+    def _discard_stale(self, session, models) -> Dict[str, int]:
+        # the rows are locked until the commit, a second poller writing the same change finds it already done
+        usernames = set(self.went_online) | set(self.went_offline) | set(self.removed)
+        if not usernames:
+            return {}
+        current = {row.username: row for row in
+                   session.execute(models.select().where(models.c.username.in_(usernames)).with_for_update())}
+        self.stale = {username: bool(current[username].online) if username in current else None
+                      for username in usernames
+                      if username not in current or
+                      (username in self.went_online and current[username].online) or
+                      (username in self.went_offline and not current[username].online)}
+        self.went_online = {username: status for username, status in self.went_online.items()
+                            if username in current and not current[username].online}
+        self.went_offline = {username: status for username, status in self.went_offline.items()
+                             if username in current and current[username].online}
+        self.removed = {username: status for username, status in self.removed.items() if username in current}
+        return {username: row.id for username, row in current.items()}
+
+    def events(self) -> List[Tuple[str, str, str, Optional[List[int]]]]:
+        """
+        :return: (kind, username, status, chatids) of every change in the batch, kind is online, offline or removed,
+                 chatids is None for the changes which concern every follower of the model
+        """
+        return [(kind, username, status, self.removed_chats.get(username, []) if kind == "removed" else None)
+                for kind, changes in (("online", self.went_online), ("offline", self.went_offline),
+                                      ("removed", self.removed))
+                for username, status in changes.items()]
+
+    def apply(self, subscription_index: SubscriptionIndex) -> None:
+        """
+        Mirrors the persisted batch in the in-memory subscription index, and the database in the entries of the
+        changes dropped because they had already been written
+
+        :param subscription_index: The index to update
+        """
+        for username in self.went_online:
+            subscription_index.set_online(username, True)
+        for username in self.went_offline:
+            subscription_index.set_online(username, False)
+        for username in self.removed:
+            subscription_index.remove_model(username)
+        for username, online in self.stale.items():
+            if online is None:
+                subscription_index.remove_model(username)
+            else:
+                subscription_index.set_online(username, online)
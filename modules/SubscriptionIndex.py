@@ -0,0 +1,187 @@
+import logging
+import threading
+from typing import Dict, List, Set, Tuple
+
+from modules.alchemy import Alchemy, ChaturbateModel, Subscription, SubscriptionVersion
+
+
+def mark_changed(session) -> None:
+    """
+    Increases the subscription version in the current transaction, so the pollers of the other processes reload
+    their index once it commits
+
+    :param session: The session whose transaction changes the subscriptions
+    """
+    session.query(SubscriptionVersion).filter_by(id=1).update({SubscriptionVersion.version:
+                                                                   SubscriptionVersion.version + 1},
+                                                              synchronize_session=False)
+
+
+def _read_version(session) -> int:
+    row = session.query(SubscriptionVersion.version).filter_by(id=1).first()
+    return row.version if row is not None else 0
+
+
+class SubscriptionIndex:
+
+    def __init__(self, alchemy_instance: Alchemy):
+        """
+        In-memory index of the followed models, with their online status and followers,
+        kept up to date by the bot itself or, in the other processes, reloaded when the subscription version changes
+
+        :param alchemy_instance: The database used to load and reconcile the index
+        """
+        self.alchemy_instance = alchemy_instance
+        self._lock = threading.RLock()
+        self._online: Dict[str, bool] = {}  # username -> online
+        self._chats: Dict[str, Set[int]] = {}  # username -> chatids
+        self._version = None  # the subscription version loaded
+
+    def _read_database(self) -> Tuple[Dict[str, bool], Dict[str, Set[int]]]:
+        online = {}
+        chats = {}
+        # read first and in the same transaction, a change committed meanwhile is reloaded by the next refresh
+        self._version = _read_version(self.alchemy_instance.session)
+        for row in self.alchemy_instance.session.query(ChaturbateModel.username, ChaturbateModel.online,
+                                                       Subscription.chat_id).join(
+                Subscription, Subscription.model_id == ChaturbateModel.id).all():
+            online[row.username] = bool(row.online)
+            chats.setdefault(row.username, set()).add(row.chat_id)
+        self.alchemy_instance.session.commit()  # end the read transaction
+        return online, chats
+
+    def load(self) -> None:
+        """
+        Loads the whole index from the database
+        """
+        online, chats = self._read_database()
+        with self._lock:
+            self._online, self._chats = online, chats
+        logging.info(f'Subscription index loaded with {len(online)} models')
+
+    def reconcile(self) -> int:
+        """
+        Reloads the index from the database and logs any drift from the in-memory copy
+
+        :return: The number of models and subscriptions that were different
+        """
+        online, chats = self._read_database()
+        with self._lock:
+            drift = len(set(self._online.items()) ^ set(online.items()))
+            drift += len({(username, chatid) for username, chatids in self._chats.items() for chatid in chatids} ^
+                         {(username, chatid) for username, chatids in chats.items() for chatid in chatids})
+            self._online, self._chats = online, chats
+        if drift:
+            logging.warning(f'Subscription index reconciliation fixed {drift} entries')
+        return drift
+
+    def refresh(self) -> bool:
+        """
+        Reloads the index if the subscriptions have been changed by another process since it was loaded
+
+        :return: True if the index has been reloaded
+        """
+        session = self.alchemy_instance.session
+        version = _read_version(session)
+        session.commit()  # end the read transaction
+        if version == self._version:
+            return False
+        online, chats = self._read_database()
+        with self._lock:
+            self._online, self._chats = online, chats
+        return True
+
+    def refresh_online(self, usernames: List[str], chunk_size: int = 500) -> Dict[str, bool]:
+        """
+        Reloads the online status of some models, written by the poller which owned them until now
+
+        :param usernames: The usernames to reload
+        :param chunk_size: The usernames read by a single query
+        :return: username -> online stored in the database, the usernames which are gone are missing
+        """
+        session = self.alchemy_instance.session
+        online = {}
+        for i in range(0, len(usernames), chunk_size):
+            for row in session.query(ChaturbateModel.username, ChaturbateModel.online).filter(
+                    ChaturbateModel.username.in_(usernames[i:i + chunk_size])):
+                online[row.username] = bool(row.online)
+        session.commit()  # end the read transaction
+        with self._lock:
+            for username in usernames:
+                if username not in online:
+                    self.remove_model(username)
+                elif username in self._online:
+                    self._online[username] = online[username]
+        return online
+
+    def add(self, username: str, chatid: int, online: bool = False) -> None:
+        """
+        Adds a subscription of chatid to username
+
+        :param username: The followed username
+        :param chatid: The chatid of the follower
+        :param online: The online status of the model stored in the database, used if the model is new to the index
+        """
+        with self._lock:
+            self._online.setdefault(username, online)
+            self._chats.setdefault(username, set()).add(int(chatid))
+
+    def remove(self, username: str, chatid: int) -> None:
+        """
+        Removes the subscription of chatid to username, if present
+
+        :param username: The followed username
+        :param chatid: The chatid of the follower
+        """
+        with self._lock:
+            chats = self._chats.get(username)
+            if chats is None:
+                return
+            chats.discard(int(chatid))
+            if not chats:
+                self.remove_model(username)
+
+    def remove_chat(self, chatid: int) -> None:
+        """
+        Removes every subscription of chatid
+
+        :param chatid: The chatid of the follower
+        """
+        with self._lock:
+            for username in list(self._chats.keys()):
+                self.remove(username, chatid)
+
+    def remove_model(self, username: str) -> None:
+        """
+        Removes a model and all of its subscriptions
+
+        :param username: The followed username
+        """
+        with self._lock:
+            self._online.pop(username, None)
+            self._chats.pop(username, None)
+
+    def set_online(self, username: str, online: bool) -> None:
+        """
+        Updates the online status of a model, if present
+
+        :param username: The followed username
+        :param online: The new online status
+        """
+        with self._lock:
+            if username in self._online:
+                self._online[username] = online
+
+    def usernames(self) -> List[str]:
+        """
+        :return: Every username followed by at least one chat
+        """
+        with self._lock:
+            return list(self._online.keys())
+
+    def snapshot(self) -> Dict[str, Tuple[bool, Set[int]]]:
+        """
+        :return: username -> (online, chatids), a copy of the whole index which can be iterated without holding the lock
+        """
+        with self._lock:
+            return {username: (online, set(self._chats[username])) for username, online in self._online.items()}
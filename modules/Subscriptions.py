@@ -0,0 +1,168 @@
+from typing import Dict, List, Tuple
+
+from sqlalchemy import exists, tuple_
+from sqlalchemy.dialects import postgresql
+
+from modules import Utils
+from modules.SubscriptionIndex import mark_changed
+from modules.alchemy import ChaturbateModel, Subscription
+
+
+def _insert_ignoring_conflicts(session, table, rows: List[dict], index_elements: List[str]) -> None:
+    """
+    INSERT ... ON CONFLICT DO NOTHING, the rows which already exist are skipped
+    """
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(table).on_conflict_do_nothing(index_elements=index_elements)
+    elif dialect == "sqlite":
+        statement = table.insert().prefix_with("OR IGNORE")
+    else:  # no portable upsert, skip the rows already there
+        key = tuple_(*[table.c[column] for column in index_elements])
+        existing = {tuple(row) for row in session.query(*[table.c[column] for column in index_elements]).filter(
+            key.in_([tuple(row[column] for column in index_elements) for row in rows]))}
+        rows = [row for row in rows if tuple(row[column] for column in index_elements) not in existing]
+        if not rows:
+            return
+        statement = table.insert()
+    session.execute(statement, rows)
+
+
+def subscribe(chatid: int, usernames: List[str]) -> Dict[str, bool]:
+    """
+    Subscribes chatid to every username in a single transaction, adding the models nobody follows
+
+    :param chatid: The chatid of the follower
+    :param usernames: The usernames to follow, the ones already followed are left as they are
+    :return: username -> online, the status of the model known by the pollers
+    """
+    if not usernames:
+        return {}
+    session = Utils.alchemy_instance.session
+    models = ChaturbateModel.__table__
+    subscriptions = Subscription.__table__
+    try:
+        _insert_ignoring_conflicts(session, models, [dict(username=username, online=False) for username in usernames],
+                                   ["username"])
+        # nobody polled the models since their last follower left, their status is stale
+        session.execute(models.update().where(models.c.username.in_(usernames)).where(
+            ~exists().where(subscriptions.c.model_id == models.c.id)).values(online=False))
+        rows = session.query(ChaturbateModel.id, ChaturbateModel.username, ChaturbateModel.online).filter(
+            ChaturbateModel.username.in_(usernames)).all()
+        _insert_ignoring_conflicts(session, subscriptions, [dict(model_id=row.id, chat_id=int(chatid)) for row in rows],
+                                   ["model_id", "chat_id"])
+        mark_changed(session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    Utils.list_pages.invalidate(str(chatid))
+    return {row.username: bool(row.online) for row in rows}
+
+
+def unsubscribe(chatid: int, usernames: List[str]) -> int:
+    """
+    Removes the subscriptions of chatid to usernames
+
+    :param chatid: The chatid of the follower
+    :param usernames: The followed usernames
+    :return: The number of deleted subscriptions
+    """
+    session = Utils.alchemy_instance.session
+    model_ids = session.query(ChaturbateModel.id).filter(ChaturbateModel.username.in_(usernames))
+    deleted = session.query(Subscription).filter(Subscription.chat_id == int(chatid),
+                                                 Subscription.model_id.in_(model_ids)).delete(
+        synchronize_session=False)
+    if deleted:
+        mark_changed(session)
+    session.commit()
+    Utils.list_pages.invalidate(str(chatid))
+    return deleted
+
+
+def unsubscribe_all(chatid: int) -> int:
+    """
+    Removes every subscription of chatid
+
+    :param chatid: The chatid of the follower
+    :return: The number of deleted subscriptions
+    """
+    session = Utils.alchemy_instance.session
+    deleted = session.query(Subscription).filter_by(chat_id=int(chatid)).delete(synchronize_session=False)
+    if deleted:
+        mark_changed(session)
+    session.commit()
+    Utils.list_pages.invalidate(str(chatid))
+    return deleted
+
+
+def followed(chatid: int) -> List[Tuple[str, bool]]:
+    """
+    :param chatid: The chatid of the follower
+    :return: (username, online) of every model followed by chatid, sorted by username
+    """
+    session = Utils.alchemy_instance.session
+    rows = session.query(ChaturbateModel.username, ChaturbateModel.online).join(
+        Subscription, Subscription.model_id == ChaturbateModel.id).filter(
+        Subscription.chat_id == int(chatid)).order_by(ChaturbateModel.username).all()
+    session.commit()  # end the read transaction
+    return [(row.username, bool(row.online)) for row in rows]
+
+
+def followed_page(chatid: int, offset: int, limit: int,
+                  online_only: bool = False) -> Tuple[List[Tuple[str, bool]], int]:
+    """
+    A page of the models followed by chatid, the online ones first and then by username
+
+    :param chatid: The chatid of the follower
+    :param offset: The number of models before the page
+    :param limit: The maximum number of models in the page
+    :param online_only: Only the models which are online
+    :return: ([(username, online)], the number of models in every page)
+    """
+    session = Utils.alchemy_instance.session
+    query = session.query(ChaturbateModel.username, ChaturbateModel.online).join(
+        Subscription, Subscription.model_id == ChaturbateModel.id).filter(Subscription.chat_id == int(chatid))
+    if online_only:
+        query = query.filter(ChaturbateModel.online.is_(True))
+    total = query.count()
+    rows = query.order_by(ChaturbateModel.online.desc(), ChaturbateModel.username).offset(offset).limit(limit).all()
+    session.commit()  # end the read transaction
+    return [(row.username, bool(row.online)) for row in rows], total
+
+
+def followed_usernames(chatid: int) -> List[str]:
+    """
+    :param chatid: The chatid of the follower
+    :return: The usernames followed by chatid, sorted
+    """
+    return [username for username, online in followed(chatid)]
+
+
+def subscribers(usernames: List[str]) -> Dict[str, List[int]]:
+    """
+    :param usernames: The followed usernames
+    :return: username -> chatids of its followers, the usernames nobody follows are missing
+    """
+    if not usernames:
+        return {}
+    session = Utils.alchemy_instance.session
+    result = {}
+    for row in session.query(ChaturbateModel.username, Subscription.chat_id).join(
+            Subscription, Subscription.model_id == ChaturbateModel.id).filter(
+            ChaturbateModel.username.in_(list(usernames))):
+        result.setdefault(row.username, []).append(row.chat_id)
+    session.commit()
+    return result
+
+
+def count_followed_models() -> int:
+    """
+    :return: The number of models followed by at least one chat
+    """
+    session = Utils.alchemy_instance.session
+    count = session.query(Subscription.model_id).distinct().count()
+    session.commit()
+    return count
@@ -1,13 +1,23 @@
 import datetime
 import logging
 
+from modules.Cache import TTLCache
+from modules.SubscriptionIndex import SubscriptionIndex
 from modules.alchemy import Alchemy, Admin
 from modules.argparse_code import args
 
 bot_path = args["working_folder"]
 last_spam_dict = {}
 temp_ban_chatid_dict = {}
+admin_cache = TTLCache(args["cache_size"], args["cache_ttl"])  # chatid -> is admin
+# username -> (file_id, image hash, upload time) of the last uploaded stream image, reused while the image is similar
+photo_file_ids = TTLCache(args["cache_size"], 24 * 3600, refresh_on_get=False)
+# (chatid, message_id) -> hash of the stream image shown in the message
+message_image_hashes = TTLCache(args["cache_size"], 24 * 3600, refresh_on_get=False)
+# chatid -> {(filter, page): (text, keyboard)} of the rendered /list pages, invalidated when the list changes
+list_pages = TTLCache(args["cache_size"], args["cache_ttl"], refresh_on_get=False)
 alchemy_instance: Alchemy
+subscription_index: SubscriptionIndex
 
 
 def handle_exception(e: Exception) -> None:
@@ -60,13 +70,25 @@ def admin_check(chatid: str) -> bool:
     :param str chatid: chatid
     :return: True if admin, False if not
     """
-    admin_list = []
-    results: Admin = alchemy_instance.session.query(Admin).filter_by(chat_id=str(chatid)).first()
+    is_admin = admin_cache.get(str(chatid))
+    if is_admin is not None:
+        return is_admin
 
-    if results is None:
-        return False
-    else:
-        return True
+    results: Admin = alchemy_instance.session.query(Admin).filter_by(chat_id=int(chatid)).first()
+    is_admin = results is not None
+    admin_cache.set(str(chatid), is_admin)
+    return is_admin
+
+
+def add_admin(chatid: str) -> None:
+    """
+    Adds the user to the admin database
+
+    :param str chatid: chatid
+    """
+    alchemy_instance.session.add(Admin(chat_id=int(chatid)))
+    alchemy_instance.session.commit()
+    admin_cache.set(str(chatid), True)
 
 
 def set_last_spam_date(chatid: str, date: datetime.datetime):
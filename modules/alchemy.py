@@ -1,33 +1,166 @@
+import logging
+
 import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import create_engine, event, Column, Integer, String, Boolean, BigInteger, ForeignKey, Index, Text, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 Base = declarative_base()
 
 
-class ChaturbateUser(Base):
-    __tablename__ = 'CHATURBATE'
-    username = Column(String(60), primary_key=True)
-    chat_id = Column(String(100), primary_key=True)
-    online = Column(Boolean)
+class ChaturbateModel(Base):
+    __tablename__ = 'MODELS'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    username = Column(String(60), unique=True, nullable=False)
+    status = Column(String(20))  # the status found when online last changed
+    online = Column(Boolean, default=False, nullable=False)
+
+
+class Subscription(Base):
+    __tablename__ = 'SUBSCRIPTIONS'
+    model_id = Column(Integer, ForeignKey('MODELS.id', ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    __table_args__ = (Index('ix_subscriptions_chat_id_model_id', 'chat_id', 'model_id'),)  # the pk serves model_id
 
 
 class Admin(Base):
     __tablename__ = 'ADMIN'
-    chat_id = Column(String(100), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
 
 
 class PreferenceUser(Base):
     __tablename__ = 'PREFERENCES'
-    chat_id = Column(String(100), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     link_preview = Column(Integer, default=1)
     notifications_sound = Column(Boolean, default=True)
 
 
+class SubscriptionVersion(Base):
+    __tablename__ = 'SUBSCRIPTION_VERSION'
+    id = Column(Integer, primary_key=True)  # a single row
+    version = Column(Integer, default=0, nullable=False)  # increased by every change of the subscriptions
+
+
+class PollerWorker(Base):
+    __tablename__ = 'POLLER_WORKER'
+    worker_id = Column(String(100), primary_key=True)
+    beat = Column(Integer, default=0)  # increased at every heartbeat, compared locally so clocks don't matter
+
+
+class OutboxEvent(Base):
+    __tablename__ = 'OUTBOX'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(10))  # online, offline or removed
+    username = Column(String(60))
+    chat_id = Column(BigInteger)  # only for removed, the other events are for every subscriber
+    status = Column(String(20))
+
+
+class BroadcastJob(Base):
+    __tablename__ = 'BROADCAST'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    admin_chat_id = Column(BigInteger)
+    message = Column(Text)
+    total = Column(Integer)  # the recipients when the broadcast started
+    last_chat_id = Column(BigInteger)  # checkpoint, every recipient up to this chat_id has been handled
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    progress_message_id = Column(Integer)
+    finished = Column(Boolean, default=False)
+
+
+def _convert_chat_id_column(connection, table_name: str) -> None:
+    """
+    Changes the chat_id column of an existing table from a string to a BIGINT
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(f'ALTER TABLE "{table_name}" ALTER COLUMN chat_id TYPE BIGINT USING chat_id::bigint'))
+        return
+    # sqlite can't alter a column, the table is copied instead
+    columns = [column.name for column in Base.metadata.tables[table_name].columns]
+    selected = ", ".join("CAST(chat_id AS BIGINT)" if column == "chat_id" else column for column in columns)
+    connection.execute(text(f'ALTER TABLE "{table_name}" RENAME TO "{table_name}_OLD"'))
+    Base.metadata.tables[table_name].create(connection)
+    connection.execute(text(f'INSERT INTO "{table_name}" ({", ".join(columns)}) '
+                            f'SELECT {selected} FROM "{table_name}_OLD"'))
+    connection.execute(text(f'DROP TABLE "{table_name}_OLD"'))
+
+
+def migrate(engine) -> None:
+    """
+    Creates the missing tables and migrates in place the databases created by the previous versions:
+    the CHATURBATE table, with a row and an online flag for every subscriber of a model, is split into MODELS and
+    SUBSCRIPTIONS, chat ids stored as strings become BIGINTs
+
+    :param engine: The engine of the database to migrate
+    """
+    with engine.begin() as connection:
+        inspector = sqlalchemy.inspect(connection)
+        tables = set(inspector.get_table_names())
+        string_chat_ids = [table_name for table_name in ("ADMIN", "PREFERENCES", "OUTBOX") if table_name in tables and
+                           isinstance([column["type"] for column in inspector.get_columns(table_name)
+                                       if column["name"] == "chat_id"][0], sqlalchemy.String)]
+        Base.metadata.create_all(connection)
+
+        for table_name in string_chat_ids:
+            logging.warning(f"Migrating the chat ids of {table_name} to integers")
+            _convert_chat_id_column(connection, table_name)
+
+        if "CHATURBATE" in tables:
+            logging.warning("Migrating the CHATURBATE table to MODELS and SUBSCRIPTIONS")
+            # a model is online if any of its subscribers has already been notified that it is
+            connection.execute(text(
+                'INSERT INTO "MODELS" (username, online) '
+                'SELECT username, MAX(CASE WHEN online THEN 1 ELSE 0 END) = 1 FROM "CHATURBATE" GROUP BY username'))
+            connection.execute(text(
+                'INSERT INTO "SUBSCRIPTIONS" (model_id, chat_id) '
+                'SELECT DISTINCT "MODELS".id, CAST("CHATURBATE".chat_id AS BIGINT) FROM "CHATURBATE" '
+                'JOIN "MODELS" ON "MODELS".username = "CHATURBATE".username'))
+            connection.execute(text('DROP TABLE "CHATURBATE"'))
+
+        if connection.dialect.name in ("postgresql", "sqlite"):  # many processes may start at once
+            connection.execute(text('INSERT INTO "SUBSCRIPTION_VERSION" (id, version) VALUES (1, 0) '
+                                    'ON CONFLICT DO NOTHING'))
+        elif connection.execute(text('SELECT id FROM "SUBSCRIPTION_VERSION"')).first() is None:
+            connection.execute(text('INSERT INTO "SUBSCRIPTION_VERSION" (id, version) VALUES (1, 0)'))
+
+
+def configure_sqlite(engine, busy_timeout: int) -> None:
+    """
+    Tunes every connection of a sqlite engine for many threads reading while the poller writes:
+    readers don't block the writer with WAL journaling, synchronous=NORMAL syncs at checkpoints instead of at every
+    commit, and writers waiting for the lock retry for busy_timeout milliseconds instead of failing
+
+    :param engine: A sqlite engine
+    :param busy_timeout: Milliseconds to wait for a locked database
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 class Alchemy:
-    def __init__(self, connection="postgresql://127.0.0.1:5432/ChaturbateBot"):
+    def __init__(self, connection="postgresql://127.0.0.1:5432/ChaturbateBot", echo: bool = False,
+                 sqlite_busy_timeout: int = 5000):
+        """
+        :param connection: The database connection string, sqlite:///path/to/file.db for a single-node deployment
+        :param echo: Log every statement, through the logging handlers rather than a handler of its own
+        :param sqlite_busy_timeout: Milliseconds a sqlite connection waits for a locked database
+        """
         self.connection = connection
-        engine = create_engine(self.connection, echo=True)
-        Base.metadata.create_all(engine)
-        self.session: sqlalchemy.orm.Session = scoped_session(sessionmaker(bind=engine))
+        if self.connection.startswith("sqlite"):
+            # sessions are scoped to their thread, but the pool hands a connection to whichever thread checks it out
+            self.engine = create_engine(self.connection, connect_args={"check_same_thread": False})
+            configure_sqlite(self.engine, sqlite_busy_timeout)
+        else:
+            self.engine = create_engine(self.connection)
+        if echo:  # create_engine(echo=True) would also write every statement to stdout, synchronously
+            logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+        migrate(self.engine)
+        self.session: sqlalchemy.orm.Session = scoped_session(sessionmaker(bind=self.engine))
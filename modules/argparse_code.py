@@ -25,6 +25,313 @@ ap.add_argument(
     type=int,
     default=10,
     help="The number of multiple http connection opened at the same time to check chaturbate. Default = 10")
+ap.add_argument(
+    "--poller",
+    required=False,
+    type=str,
+    choices=["threads", "asyncio"],
+    default="threads",
+    help="How models are checked: a pool of threads or a single asyncio event loop. Default = threads")
+ap.add_argument(
+    "--concurrency",
+    required=False,
+    type=int,
+    default=100,
+    help="The maximum number of http connections in flight when using the asyncio poller. Default = 100")
+ap.add_argument(
+    "--adaptive-concurrency",
+    required=False,
+    default=False,
+    help="Adapt the number of status requests in flight to chaturbate's latency and blocks, between --min-concurrency and --concurrency (or -threads). Default = False")
+ap.add_argument(
+    "--min-concurrency",
+    required=False,
+    type=int,
+    default=1,
+    help="The lowest number of status requests in flight when --adaptive-concurrency is enabled. Default = 1")
+ap.add_argument(
+    "--reconcile-interval",
+    required=False,
+    type=float,
+    default=600,
+    help="Seconds between reloads of the in-memory subscription index from the database. Default = 600s")
+ap.add_argument(
+    "--cache-size",
+    required=False,
+    type=int,
+    default=10000,
+    help="The maximum number of users whose preferences and admin status are kept in memory. Default = 10000")
+ap.add_argument(
+    "--cache-ttl",
+    required=False,
+    type=float,
+    default=3600,
+    help="Seconds after which an unused cached preference is evicted, 0 = never. Default = 3600s")
+ap.add_argument(
+    "--notification-workers",
+    required=False,
+    type=int,
+    default=4,
+    help="The number of threads sending notifications to telegram. Default = 4")
+ap.add_argument(
+    "--global-rate-limit",
+    required=False,
+    type=float,
+    default=30,
+    help="The maximum number of notifications sent every second. Default = 30")
+ap.add_argument(
+    "--chat-rate-limit",
+    required=False,
+    type=float,
+    default=1,
+    help="The maximum number of notifications sent every second to the same chat. Default = 1")
+ap.add_argument(
+    "--broadcast-chunk-size",
+    required=False,
+    type=int,
+    default=500,
+    help="Recipients of /send_message_to_everyone read and checkpointed at once, a restarted bot resumes the broadcast "
+         "from the last checkpoint. Default = 500")
+ap.add_argument(
+    "--file-id-ttl",
+    required=False,
+    type=float,
+    default=30,
+    help="Seconds during which an uploaded stream image is reused instead of downloading a new one. Default = 30s")
+ap.add_argument(
+    "--image-max-size",
+    required=False,
+    type=int,
+    default=640,
+    help="Stream images are downscaled so that their longest side is at most this many pixels, 0 keeps the original size. Default = 640")
+ap.add_argument(
+    "--image-quality",
+    required=False,
+    type=int,
+    default=75,
+    help="JPEG quality of the recompressed stream images, from 1 to 95. Default = 75")
+ap.add_argument(
+    "--image-hash-threshold",
+    required=False,
+    type=int,
+    default=4,
+    help="Stream images whose perceptual hashes differ by at most this many bits out of 64 are considered the same frame and not uploaded again. Default = 4")
+ap.add_argument(
+    "--model-cache-ttl",
+    required=False,
+    type=float,
+    default=10,
+    help="Seconds a model status or stream image is reused by commands before being fetched again. Default = 10s")
+ap.add_argument(
+    "--add-timeout",
+    required=False,
+    type=float,
+    default=10,
+    help="Seconds /add waits for the usernames to be checked, the ones still unchecked are not added. Default = 10s")
+ap.add_argument(
+    "--http-pool-size",
+    required=False,
+    type=int,
+    default=10,
+    help="The number of keep-alive connections kept open to every chaturbate host. Default = 10")
+ap.add_argument(
+    "--http-keepalive",
+    required=False,
+    type=float,
+    default=30,
+    help="Seconds an idle connection is kept open by the asyncio poller. Default = 30s")
+ap.add_argument(
+    "--connect-timeout",
+    required=False,
+    type=float,
+    default=5,
+    help="Seconds to wait for a connection to chaturbate. Default = 5s")
+ap.add_argument(
+    "--read-timeout",
+    required=False,
+    type=float,
+    default=10,
+    help="Seconds to wait for chaturbate to answer. Default = 10s")
+ap.add_argument(
+    "--min-poll-interval",
+    required=False,
+    type=float,
+    default=15,
+    help="Seconds between two checks of a model which is online or usually streams at this time. Default = 15s")
+ap.add_argument(
+    "--max-poll-interval",
+    required=False,
+    type=float,
+    default=300,
+    help="The maximum seconds between two checks of a model, the worst case notification delay. Default = 300s")
+ap.add_argument(
+    "--retry-interval",
+    required=False,
+    type=float,
+    default=2,
+    help="Seconds before a failed model check is retried, doubled after every consecutive failure. Default = 2s")
+ap.add_argument(
+    "--breaker-threshold",
+    required=False,
+    type=int,
+    default=5,
+    help="Consecutive failures after which a model is parked. Default = 5")
+ap.add_argument(
+    "--breaker-park-time",
+    required=False,
+    type=float,
+    default=600,
+    help="Seconds a parked model isn't checked. Default = 600s")
+ap.add_argument(
+    "--shard-poller",
+    required=False,
+    default=False,
+    help="Share the models with the other pollers using the same database, each polls its own shard. Default = False")
+ap.add_argument(
+    "--role",
+    required=False,
+    type=str,
+    choices=["all", "bot", "poller"],
+    default="all",
+    help="all: a single process does everything. bot: answers commands and sends the notifications published by the pollers. poller: checks the models and publishes their status changes, see bot.py and poller.py. Default = all")
+ap.add_argument(
+    "--outbox-poll-interval",
+    required=False,
+    type=float,
+    default=5,
+    help="The longest time between two reads of the status changes published by the pollers, on postgres they are also delivered with LISTEN/NOTIFY. Default = 5s")
+ap.add_argument(
+    "--shard-lease-time",
+    required=False,
+    type=float,
+    default=30,
+    help="Seconds without heartbeats after which a poller's shard is taken over by the others. Default = 30s")
+ap.add_argument(
+    "--shard-heartbeat-interval",
+    required=False,
+    type=float,
+    default=5,
+    help="Seconds between two heartbeats of a sharded poller. Default = 5s")
+ap.add_argument(
+    "--dispatcher-workers",
+    required=False,
+    type=int,
+    default=4,
+    help="Threads running the slow command handlers (/add, /stream_image...) concurrently. Default = 4")
+ap.add_argument(
+    "--webhook-url",
+    required=False,
+    type=str,
+    default=None,
+    help="Public https url telegram sends the updates to, the webhook path is appended. Default = long polling instead of a webhook")
+ap.add_argument(
+    "--webhook-listen",
+    required=False,
+    type=str,
+    default="0.0.0.0",
+    help="Address the webhook server listens on. Default = 0.0.0.0")
+ap.add_argument(
+    "--webhook-port",
+    required=False,
+    type=int,
+    default=8443,
+    help="Port the webhook server listens on. Default = 8443")
+ap.add_argument(
+    "--webhook-path",
+    required=False,
+    type=str,
+    default=None,
+    help="Path of the webhook, so only telegram knows where to send updates. Default = the bot api key")
+ap.add_argument(
+    "--webhook-cert",
+    required=False,
+    type=str,
+    default=None,
+    help="Certificate file of the webhook server, not needed behind a tls terminating reverse proxy")
+ap.add_argument(
+    "--webhook-key",
+    required=False,
+    type=str,
+    default=None,
+    help="Private key file of the webhook server certificate")
+ap.add_argument(
+    "--metrics-port",
+    required=False,
+    type=int,
+    default=0,
+    help="Port of the prometheus metrics endpoint, 0 disables it. Default = 0")
+ap.add_argument(
+    "--metrics-address",
+    required=False,
+    type=str,
+    default="127.0.0.1",
+    help="Address the metrics endpoint listens on. Default = 127.0.0.1")
+ap.add_argument(
+    "--status-url",
+    required=False,
+    type=str,
+    default=None,
+    help="Template of the model status url, {username} is replaced. Default = chaturbate's chatvideocontext api")
+ap.add_argument(
+    "--image-url",
+    required=False,
+    type=str,
+    default=None,
+    help="Template of the stream image url, {username} is replaced. Default = chaturbate's roomimg server")
+ap.add_argument(
+    "--telegram-url",
+    required=False,
+    type=str,
+    default=None,
+    help="Base url of the telegram bot api, the token is appended. Default = https://api.telegram.org/bot")
+ap.add_argument(
+    "--profile-cycles",
+    required=False,
+    type=int,
+    default=0,
+    help="Profile the first poll cycles, the profile is written to the working folder, see also /profile. Default = 0")
+ap.add_argument(
+    "--profile-handlers",
+    required=False,
+    type=int,
+    default=0,
+    help="Profile the first command handler calls, the profile is written to the working folder. Default = 0")
+ap.add_argument(
+    "--log-queue",
+    required=False,
+    type=str,
+    default="True",
+    help="Write the log from a background thread, so logging never waits for the disk. Default = True")
+ap.add_argument(
+    "--log-max-bytes",
+    required=False,
+    type=int,
+    default=10485760,
+    help="Size in bytes at which the logging file is rotated, 0 never rotates it. Default = 10485760")
+ap.add_argument(
+    "--log-backup-count",
+    required=False,
+    type=int,
+    default=5,
+    help="The number of rotated logging files kept. Default = 5")
+ap.add_argument(
+    "--log-rate-limit",
+    required=False,
+    type=int,
+    default=20,
+    help="The messages every line of the bot logs in --log-rate-interval before they are sampled, 0 = unlimited. Default = 20")
+ap.add_argument(
+    "--log-rate-interval",
+    required=False,
+    type=float,
+    default=60,
+    help="Seconds of a --log-rate-limit window. Default = 60s")
+ap.add_argument(
+    "--log-sample",
+    required=False,
+    type=int,
+    default=100,
+    help="Past --log-rate-limit, one message every this many is logged with the number of dropped ones. Default = 100")
 ap.add_argument(
     "-l",
     "--limit",
@@ -60,6 +367,19 @@ ap.add_argument(
     required=False,
     type=str,
     default="postgresql://127.0.0.1:5432/ChaturbateBot",
-    help=f"Database connection string, default = postgresql://127.0.0.1:5432/ChaturbateBot")
+    help=f"Database connection string, use sqlite:///path/to/file.db for a single-node deployment without a database "
+         f"server, default = postgresql://127.0.0.1:5432/ChaturbateBot")
+ap.add_argument(
+    "--database-echo",
+    required=False,
+    type=str,
+    default="False",
+    help="Log every database statement. Default = False")
+ap.add_argument(
+    "--sqlite-busy-timeout",
+    required=False,
+    type=int,
+    default=5000,
+    help="Milliseconds a sqlite connection waits for the database to be unlocked before failing. Default = 5000")
 args = vars(ap.parse_args())
 
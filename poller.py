@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the poller role of ChaturbateBot, see ChaturbateBot.py --help for the arguments
+"""
+from ChaturbateBot import main
+
+if __name__ == "__main__":
+    main("poller")